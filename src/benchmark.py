@@ -0,0 +1,393 @@
+import argparse
+import gzip
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+import tkinter
+import tracemalloc
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, TypeAlias
+
+import font_cache
+from display_item import DisplayList
+from html_parser import Comment, Element, HTMLParser, HtmlNode, Text
+from layout import Layout
+from node_store import NodeStore
+from url import URL
+
+WORDS = [
+    "lorem",
+    "ipsum",
+    "dolor",
+    "sit",
+    "amet",
+    "consectetur",
+    "adipiscing",
+    "elit",
+    "sed",
+    "do",
+    "eiusmod",
+    "tempor",
+]
+
+LAYOUT_WIDTHS = [400, 800, 1600]
+SCROLL_FRACTIONS = [0.0, 0.25, 0.5, 0.75, 1.0]
+CHUNK_SIZE = 4096
+
+Results: TypeAlias = dict[str, dict[str, float]]
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def generate_document(paragraphs: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    parts = ["<!DOCTYPE html><html><head><title>Benchmark</title></head><body>"]
+    for i in range(paragraphs):
+        words = sentence(rng, rng.randint(20, 80))
+        parts.append(f"<p class='para-{i}'>{words} <b>{words[:20]}</b></p>\n")
+        if i % 50 == 0:
+            parts.append("<script>if (a < b && c > d) { x = '<p>'; }</script>")
+            parts.append("<!-- section break -->")
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def generate_corpus(scale: int = 1, seed: int = 0) -> dict[str, str]:
+    rng = random.Random(seed)
+    corpus = {"paragraphs": generate_document(500 * scale, seed)}
+
+    depth = 200 * scale
+    corpus["deep_nesting"] = (
+        "<html><body>"
+        + "".join(f"<div><i>{sentence(rng, 3)}" for _ in range(depth))
+        + "</i></div>" * depth
+        + "</body></html>"
+    )
+
+    corpus["long_paragraphs"] = "".join(
+        f"<p>{sentence(rng, 5_000)}</p>" for _ in range(10 * scale)
+    )
+
+    entities = ["&amp;", "&lt;", "&gt;", "&copy;", "&mdash;", "&hellip;", "&nbsp;"]
+    corpus["entities"] = "".join(
+        "<p>"
+        + " ".join(f"{rng.choice(WORDS)}{rng.choice(entities)}" for _ in range(50))
+        + "</p>"
+        for _ in range(200 * scale)
+    )
+
+    corpus["soft_hyphens"] = "".join(
+        "<p>"
+        + " ".join("\N{SOFT HYPHEN}".join(rng.sample(WORDS, 4)) for _ in range(40))
+        + "</p>"
+        for _ in range(200 * scale)
+    )
+
+    corpus["sup_sub"] = "".join(
+        f"<p>{sentence(rng, 5)}<sup>{sentence(rng, 2)}</sup> {sentence(rng, 5)}"
+        f"<sub>{sentence(rng, 2)}</sub> <big>{sentence(rng, 3)}</big></p>"
+        for _ in range(500 * scale)
+    )
+
+    corpus["flat_list"] = (
+        "<ul>"
+        + "".join(f"<li>{sentence(rng, 4)}" for _ in range(5_000 * scale))
+        + "</ul>"
+    )
+    return corpus
+
+
+def time_phase(fn: Callable[[], Any], repeat: int) -> dict[str, float]:
+    times: list[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    # Tracing allocations slows things down, so peak memory gets its own run
+    tracemalloc.start()
+    fn()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "median_ms": statistics.median(times) * 1000,
+        "min_ms": min(times) * 1000,
+        "peak_kb": peak / 1024,
+    }
+
+
+def parse_chunked(body: str):
+    parser = HTMLParser()
+    for i in range(0, len(body), CHUNK_SIZE):
+        parser.feed(body[i : i + CHUNK_SIZE])
+    return parser.close()
+
+
+def bench_documents(corpus: dict[str, str], repeat: int, results: Results):
+    for name, body in corpus.items():
+        results[f"parse/{name}"] = time_phase(lambda: HTMLParser(body).parse(), repeat)
+        results[f"parse_chunked/{name}"] = time_phase(
+            lambda: parse_chunked(body), repeat
+        )
+
+        root = HTMLParser(body).parse()
+        for width in LAYOUT_WIDTHS:
+            results[f"layout/{name}/{width}"] = time_phase(
+                lambda: Layout(root).render(width), repeat
+            )
+
+        # Renders after the first only reflow the measured runs
+        layout = Layout(root)
+        layout.render(LAYOUT_WIDTHS[0])
+        for width in LAYOUT_WIDTHS:
+            results[f"reflow/{name}/{width}"] = time_phase(
+                lambda: layout.render(width), repeat
+            )
+
+        display_list = layout.display_list
+        data = display_list.serialize()
+        results[f"serialize/{name}"] = time_phase(display_list.serialize, repeat)
+        results[f"deserialize/{name}"] = time_phase(
+            lambda: DisplayList.deserialize(data), repeat
+        )
+
+        # What reopening the page from a snapshot costs instead of parsing it
+        document = root.store.serialize()
+        results[f"serialize_document/{name}"] = time_phase(root.store.serialize, repeat)
+        results[f"deserialize_document/{name}"] = time_phase(
+            lambda: NodeStore.deserialize(document), repeat
+        )
+
+
+def bench_draw(corpus: dict[str, str], repeat: int, results: Results):
+    from browser import Browser
+
+    browser = Browser()
+    browser.window.update()
+    for name, body in corpus.items():
+        browser.layout = Layout(HTMLParser(body).parse())
+        browser.layout.render(browser.get_content_width())
+        y_max = browser.layout.get_y_max()
+
+        def cold_draw():
+            browser.drawn_list = None
+            browser.draw()
+
+        for fraction in SCROLL_FRACTIONS:
+            browser.scroll = int(y_max * fraction)
+            results[f"draw/{name}/{fraction}"] = time_phase(cold_draw, repeat)
+
+        def scroll_draw():
+            for fraction in SCROLL_FRACTIONS:
+                browser.scroll = int(y_max * fraction)
+                browser.draw()
+
+        results[f"scroll/{name}"] = time_phase(scroll_draw, repeat)
+    browser.window.destroy()
+
+
+class BenchmarkHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Otherwise small responses stall on delayed ACKs
+    disable_nagle_algorithm = True
+    body: bytes = b""
+    compressed: bytes = b""
+
+    def do_GET(self):
+        body = self.body
+        self.send_response(200)
+        if "gzip" in self.path:
+            body = self.compressed
+            self.send_header("Content-Encoding", "gzip")
+        if "chunked" in self.path:
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(body), CHUNK_SIZE):
+                chunk = body[i : i + CHUNK_SIZE]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any):
+        pass
+
+
+# The dataclass nodes the parser used to build, kept to compare memory against
+@dataclass(frozen=True)
+class LegacyElement:
+    tag: str
+    parent: "LegacyElement | None" = None
+    children: list[Any] = field(default_factory=list)
+    attrs: dict[str, str] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class LegacyText:
+    text: str
+    parent: LegacyElement | None = None
+
+
+def to_legacy(node: HtmlNode, parent: LegacyElement | None = None) -> Any:
+    match node:
+        case Element():
+            element = LegacyElement(node.tag, parent, attrs=dict(node.attrs))
+            for child in node.children:
+                element.children.append(to_legacy(child, element))
+            return element
+        case Text() | Comment():
+            return LegacyText(node.text, parent)
+
+
+def retained_kb(build: Callable[[], Any]) -> float:
+    tracemalloc.start()
+    result = build()
+    current, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current / 1024
+
+
+def bench_dom_memory(corpus: dict[str, str], results: Results):
+    for name, body in corpus.items():
+        results[f"dom_memory/{name}"] = {
+            "compact_kb": retained_kb(lambda: HTMLParser(body).parse()),
+            "dataclass_kb": retained_kb(lambda: to_legacy(HTMLParser(body).parse())),
+        }
+
+
+def bench_requests(body: str, repeat: int, results: Results):
+    BenchmarkHandler.body = body.encode("utf8")
+    BenchmarkHandler.compressed = gzip.compress(BenchmarkHandler.body)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BenchmarkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    try:
+        for path in ["plain", "gzip", "chunked", "chunked-gzip"]:
+            url = f"http://127.0.0.1:{port}/{path}"
+
+            def request():
+                content = URL(url).request()
+                assert len(content) == len(body), f"Bad response from {url}"
+
+            results[f"request/{path}"] = time_phase(request, repeat)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def run(scale: int, repeat: int, draw: bool) -> Results:
+    corpus = generate_corpus(scale)
+    results: Results = {}
+    bench_documents(corpus, repeat, results)
+    bench_dom_memory(corpus, results)
+    if draw:
+        try:
+            bench_draw(corpus, repeat, results)
+        except tkinter.TclError as e:
+            print(f"Skipping draw benchmarks: {e}", file=sys.stderr)
+    bench_requests(corpus["paragraphs"], repeat, results)
+    return results
+
+
+def find_regressions(
+    results: Results,
+    baseline: Results,
+    max_regression: float,
+    thresholds: dict[str, float],
+) -> list[str]:
+    regressions: list[str] = []
+    for phase, result in results.items():
+        if phase not in baseline or "median_ms" not in result:
+            continue
+        # Per-phase thresholds match on prefix, e.g. "layout/" or "draw/flat_list"
+        allowed = max_regression
+        for prefix, threshold in thresholds.items():
+            if phase.startswith(prefix):
+                allowed = threshold
+        before = baseline[phase]["median_ms"]
+        after = result["median_ms"]
+        if after > before * (1 + allowed):
+            regressions.append(
+                f"{phase}: {before:.1f} ms -> {after:.1f} ms "
+                f"(+{(after / before - 1) * 100:.0f}%, allowed +{allowed * 100:.0f}%)"
+            )
+    return regressions
+
+
+def parse_threshold(text: str) -> tuple[str, float]:
+    phase, threshold = text.split("=", 1)
+    return phase, float(threshold)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Slama end-to-end benchmarks")
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--scale", type=int, default=1, help="corpus size factor")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.25,
+        help="allowed slowdown of a phase's median as a fraction of the baseline",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=parse_threshold,
+        action="append",
+        default=[],
+        metavar="PHASE=FRACTION",
+        help="override --max-regression for phases starting with PHASE",
+    )
+    parser.add_argument(
+        "--tk",
+        action="store_true",
+        help="measure text with Tk instead of the deterministic headless tables",
+    )
+    parser.add_argument("--no-draw", action="store_true", help="skip Browser.draw")
+    args = parser.parse_args()
+
+    if not args.tk:
+        font_cache.set_backend(font_cache.TableTextMetrics.approximate())
+
+    results = run(args.scale, args.repeat, not args.no_draw)
+    for phase, result in results.items():
+        if "median_ms" in result:
+            print(
+                f"{phase:40} {result['median_ms']:10.2f} ms "
+                f"{result['peak_kb']:12.0f} KiB peak"
+            )
+        else:
+            print(
+                f"{phase:40} {result['compact_kb']:10.0f} KiB "
+                f"{result['dataclass_kb']:12.0f} KiB as dataclasses"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"scale": args.scale, "repeat": args.repeat, "results": results},
+                f,
+                indent=2,
+            )
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = find_regressions(
+            results, baseline, args.max_regression, dict(args.threshold)
+        )
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
@@ -1,10 +1,20 @@
 import tkinter
 import tkinter.font
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
 from typing import TYPE_CHECKING
 
-from html_parser import HTMLParser
+import tracing
+from display_item import DisplayList
+from font_cache import WIDTHS, TableTextMetrics, get_font
+from frame_scheduler import Debouncer, FrameScheduler
+from history import DocumentCache, History, HistoryEntry
+from html_parser import Element, HTMLParser, ParseEvent, Text
 from layout import Layout
-from url import URL
+from layout_worker import LayoutPool, RemoteLayout
+from loader import POLL_INTERVAL_MS, PageLoader
+from snapshot import SnapshotLayout, remove_snapshot, save_scroll, save_snapshot
+from url import URL, pool
 
 HSTEP, VSTEP = 13, 18
 SCROLL_STEP = 100
@@ -26,9 +36,31 @@ class Browser:
     width: int
     height: int
     fonts: dict[str, tkinter.font.Font]
-    layout: Layout
+    layout: Layout | RemoteLayout | SnapshotLayout
+    # Layout for the page being loaded, until it has something to show
+    next_layout: Layout | None
+    # Lays pages out in worker processes, when enabled
+    layout_pool: LayoutPool | None
+    polling_layout: bool
+    frames: FrameScheduler
+    resize: Debouncer
+    loader: PageLoader
+    history: History
+    documents: DocumentCache
+    # Where to scroll once a page from the history has loaded again
+    restore_scroll: int | None
+    # Canvas items currently on screen, keyed by their index in the display list
+    drawn: dict[int, int]
+    drawn_list: DisplayList | None
+    drawn_scroll: int
+    scroll_bar: int | None
+    # Running max of y from the top and running min of y from the bottom. Items
+    # are only roughly sorted by y (superscripts sit above their line), so these
+    # give monotonic keys to bisect for the visible slice.
+    max_y_before: list[int]
+    min_y_after: list[int]
 
-    def __init__(self, rtl: bool = False):
+    def __init__(self, rtl: bool = False, layout_processes: bool = False):
         self.rtl = rtl
         self.window = tkinter.Tk()
         self.window.title("Slama Browser")
@@ -38,67 +70,322 @@ class Browser:
         self.canvas = tkinter.Canvas(self.window, width=self.width, height=self.height)
         self.canvas.pack(expand=True, fill="both")
         self.scroll = 0
+        self.drawn = {}
+        self.drawn_list = None
+        self.drawn_scroll = 0
+        self.scroll_bar = None
+        # Show an empty page until the first load has something to show
+        self.layout = Layout(HTMLParser().close())
+        self.layout.render(self.get_content_width())
+        self.next_layout = None
+        self.layout_pool = None
+        self.polling_layout = False
+        if layout_processes:
+            # Workers measure text with glyph tables taken from Tk's metrics
+            self.layout_pool = LayoutPool(TableTextMetrics.from_backend(WIDTHS))
+        self.history = History()
+        self.documents = DocumentCache()
+        self.restore_scroll = None
+        # Events only update the state to show; drawing happens once per frame
+        self.frames = FrameScheduler(self.window, self.draw)
+        self.resize = Debouncer(self.window, self.relayout)
+        self.loader = PageLoader(
+            self.window,
+            self.on_progress,
+            self.on_load,
+            self.on_layout,
+            self.on_unchanged,
+            self.documents,
+            self.layout_pool,
+        )
+        self.window.bind("<Escape>", self.stop)
+        self.window.bind("<Alt-Left>", self.go_back)
+        self.window.bind("<Alt-Right>", self.go_forward)
         self.window.bind("<Up>", self.scrollup)
         self.window.bind("<Down>", self.scrolldown)
         self.window.bind("<MouseWheel>", self.scrollwheel)
         self.window.bind("<Configure>", self.on_configure)
 
     def load(self, url: URL):
-        body = url.request()
-        root = HTMLParser(body).parse()
-        # Print the tree for debugging
-        HTMLParser(body).print_tree(root)
-        self.layout = Layout(root)
+        self.remember_scroll()
+        self.history.visit(url)
+        if not self.open_snapshot(url):
+            self.fetch(url)
+
+    def fetch(
+        self, url: URL, content_hash: str | None = None, revalidate: bool = False
+    ):
+        # Fetching and parsing happen off the Tk thread, and the page is laid
+        # out and drawn bit by bit as it arrives, see `on_progress`
+        self.restore_scroll = None
+        if self.layout_pool is None:
+            self.next_layout = Layout.progressive()
+        self.loader.load(url, self.get_content_width(), content_hash, revalidate)
+
+    def open_snapshot(self, url: URL) -> bool:
+        # Show the page as it was last time straight away, and only check in
+        # the background whether its source has changed since. Pages laid out
+        # in worker processes aren't hashed, so they have no snapshots.
+        if self.layout_pool is not None:
+            return False
+        snapshot = SnapshotLayout.open(url)
+        if snapshot is None:
+            return False
+        self.layout = snapshot
+        self.history.store(snapshot, snapshot.content_hash)
+        self.layout.render(self.get_content_width())
+        self.scroll = 0
+        self.add_scroll(snapshot.scroll)
+        self.frames.request()
+        self.fetch(url, snapshot.content_hash, revalidate=True)
+        return True
+
+    def save_snapshot(self):
+        # Keep the page on screen for the next session to open with
+        entry = self.history.current
+        if entry is None or entry.layout is not self.layout:
+            return
+        if entry.content_hash is None or self.layout.width is None:
+            return
+        if isinstance(self.layout, SnapshotLayout):
+            if self.layout.layout is None:
+                # Nothing but the scroll position changed since it was opened
+                save_scroll(entry.url, self.scroll)
+                return
+            root = self.layout.load_document()
+        elif isinstance(self.layout, Layout) and self.layout.root is not None:
+            root = self.layout.root
+        else:
+            return
+        save_snapshot(
+            entry.url,
+            root,
+            self.layout.display_list,
+            self.layout.width,
+            self.scroll,
+            entry.content_hash,
+        )
+
+    def close(self):
+        # Once the window has closed
+        self.loader.cancel()
+        if self.layout_pool is not None:
+            self.layout_pool.close()
+
+    def go_back(self, e: EventType):
+        self.remember_scroll()
+        self.go(self.history.back())
+
+    def go_forward(self, e: EventType):
+        self.remember_scroll()
+        self.go(self.history.forward())
+
+    def go(self, entry: HistoryEntry | None):
+        if entry is None:
+            return
+        if entry.layout is None:
+            # The page was evicted from the history, or never finished loading
+            self.fetch(entry.url, entry.content_hash)
+            self.restore_scroll = entry.scroll
+            return
+
+        self.loader.cancel()
+        self.next_layout = None
+        self.layout = entry.layout
+        if self.layout.width != self.get_content_width():
+            self.layout.render(self.get_content_width())
+            if not self.polling_layout:
+                self.poll_layout()
+        self.scroll = entry.scroll
+        self.frames.request()
+
+    def remember_scroll(self):
+        if self.history.current is not None:
+            self.history.current.scroll = self.scroll
+
+    def on_progress(self, url: URL, events: list[ParseEvent]):
+        # Keep showing the previous page until the new one has content
+        if self.next_layout is not None:
+            self.layout = self.next_layout
+            self.next_layout = None
+            self.layout.render(self.get_content_width())
+            self.scroll = 0
+        self.layout.append(events)
+        self.frames.request()
+
+    def on_load(self, url: URL, root: Element | Text, content_hash: str):
+        self.on_progress(url, [])
+        assert isinstance(self.layout, Layout)
+        self.layout.finish(root)
+        current = self.history.current
+        if current is not None and isinstance(current.layout, SnapshotLayout):
+            # The page changed since its snapshot was saved
+            remove_snapshot(url)
+        self.documents.add(content_hash, root)
+        self.history.store(self.layout, content_hash)
+        self.scroll_to_restored()
+        self.frames.request()
+
+    def on_layout(self, url: URL, runs: bytes, width: int, data: bytes):
+        assert self.layout_pool is not None
+        display_list = DisplayList.deserialize(data)
+        self.layout = RemoteLayout(self.layout_pool, runs, width, display_list)
+        self.history.store(self.layout, None)
+        self.scroll = 0
+        self.scroll_to_restored()
+        # The window may have been resized while the page was loading
         self.layout.render(self.get_content_width())
-        self.draw()
+        if not self.polling_layout:
+            self.poll_layout()
+        self.frames.request()
+
+    def on_unchanged(self, url: URL):
+        # The page on screen is still current
+        self.next_layout = None
+
+    def scroll_to_restored(self):
+        if self.restore_scroll is not None:
+            self.scroll = 0
+            self.add_scroll(self.restore_scroll)
+            self.restore_scroll = None
+
+    def poll_layout(self):
+        # Pick up display lists relaid out at a new width
+        self.polling_layout = False
+        if not isinstance(self.layout, RemoteLayout):
+            return
+        if self.layout.update():
+            self.frames.request()
+        if self.layout.is_pending():
+            self.polling_layout = True
+            self.window.after(POLL_INTERVAL_MS, self.poll_layout)
+
+    def stop(self, e: EventType):
+        self.loader.cancel()
 
     def draw(self):
-        self.canvas.delete("all")
-        for x, y, c, font in self.layout.display_list:
-            # Skip drawing characters off screen
-            if y > self.scroll + self.height:
-                continue
-            if y + VSTEP < self.scroll:
-                continue
+        with tracing.span("draw", items=len(self.layout.display_list)):
+            display_list = self.layout.display_list
+            if display_list is not self.drawn_list:
+                # The page was laid out again, so no items can be reused
+                self.canvas.delete("all")
+                self.drawn = {}
+                self.drawn_list = display_list
+                self.drawn_scroll = self.scroll
+                self.scroll_bar = None
+                ys = display_list.ys
+                self.max_y_before = list(accumulate(ys, max))
+                self.min_y_after = list(accumulate(reversed(ys), min))[::-1]
+            elif len(display_list) > len(self.max_y_before):
+                self.extend_y_bounds()
+
+            if self.scroll != self.drawn_scroll:
+                self.canvas.move("content", 0, self.drawn_scroll - self.scroll)
+                self.drawn_scroll = self.scroll
 
-            self.canvas.create_text(x, y - self.scroll, text=c, font=font, anchor="nw")
+            top = self.scroll - VSTEP
+            bottom = self.scroll + self.height
+            start = bisect_left(self.max_y_before, top)
+            end = bisect_right(self.min_y_after, bottom)
 
-        # Draw scroll bar
+            # Remove the items that scrolled out of view
+            for i in list(self.drawn):
+                if not (start <= i < end and top <= display_list.ys[i] <= bottom):
+                    self.canvas.delete(self.drawn.pop(i))
+
+            # And add the ones that scrolled into view
+            for i in range(start, end):
+                x, y, c, font = display_list[i]
+                # Skip drawing characters off screen
+                if i in self.drawn or y > bottom or y < top:
+                    continue
+                tracing.count("canvas items created")
+                self.drawn[i] = self.canvas.create_text(
+                    x,
+                    y - self.scroll,
+                    text=c,
+                    font=get_font(font.size, font.weight, font.style),
+                    anchor="nw",
+                    tags="content",
+                )
+
+            self.draw_scroll_bar()
+
+        if tracing.enabled:
+            tracing.sample("width cache", WIDTHS.stats())
+            tracing.sample("connections", pool.stats())
+            tracing.sample("counters", tracing.counters)
+
+    def extend_y_bounds(self):
+        # More lines arrived while the page is loading
+        start = len(self.max_y_before)
+        ys = self.layout.display_list.ys[start:]
+        running_max = self.max_y_before[-1] if start else ys[0]
+        for y in ys:
+            running_max = max(running_max, y)
+            self.max_y_before.append(running_max)
+
+        new_min_y_after = list(accumulate(reversed(ys), min))[::-1]
+        lowest = new_min_y_after[0]
+        i = start - 1
+        while i >= 0 and self.min_y_after[i] > lowest:
+            self.min_y_after[i] = lowest
+            i -= 1
+        self.min_y_after.extend(new_min_y_after)
+
+    def draw_scroll_bar(self):
         y_max = self.layout.get_y_max()
-        if y_max > self.height:
-            bar = self.canvas.create_rectangle(
-                self.width - SCROLL_BAR_WIDTH,
-                (self.scroll / y_max) * self.height,
-                self.width - 5,
-                ((self.scroll + self.height) / y_max) * self.height,
-            )
-            self.canvas.itemconfig(bar, fill="#999999")
+        if y_max <= self.height:
+            if self.scroll_bar is not None:
+                self.canvas.delete(self.scroll_bar)
+                self.scroll_bar = None
+            return
+
+        coords = (
+            self.width - SCROLL_BAR_WIDTH,
+            (self.scroll / y_max) * self.height,
+            self.width - 5,
+            ((self.scroll + self.height) / y_max) * self.height,
+        )
+        if self.scroll_bar is None:
+            self.scroll_bar = self.canvas.create_rectangle(*coords, fill="#999999")
+        else:
+            self.canvas.coords(self.scroll_bar, *coords)
 
     def on_configure(self, e: EventType):
         # Not sure why we're getting a configure event with a width of 1 and height of 1
         if e.width < 100:
             return
 
+        # Dragging the window edge sends a stream of these, so the page is
+        # only laid out again once the size settles
         self.height = e.height
         if e.width != self.width:
             self.width = e.width
+            self.resize.trigger()
+        self.frames.request()
+
+    def relayout(self):
+        if self.layout.width != self.get_content_width():
             self.layout.render(self.get_content_width())
-        self.draw()
+            if not self.polling_layout:
+                self.poll_layout()
+        self.frames.request()
 
     def add_scroll(self, offset: int):
         self.scroll = min(max(0, self.scroll + offset), self.layout.get_y_max())
 
     def scrolldown(self, e: EventType):
         self.add_scroll(SCROLL_STEP)
-        self.draw()
+        self.frames.request()
 
     def scrollup(self, e: EventType):
         self.add_scroll(-SCROLL_STEP)
-        self.draw()
+        self.frames.request()
 
     def scrollwheel(self, e: EventType):
         self.add_scroll(e.delta * (SCROLL_STEP // 2))
-        self.draw()
+        self.frames.request()
 
     def get_content_width(self):
         return self.width - SCROLL_BAR_WIDTH
@@ -0,0 +1,274 @@
+import errno
+import select
+import selectors
+import socket
+import ssl
+import threading
+import time
+from typing import BinaryIO, TypeAlias
+
+import tracing
+from resolver import Address, Resolver
+
+# (scheme, host, port)
+PoolKey: TypeAlias = tuple[str, str, int]
+
+
+# How long to wait on one address before also trying the next (RFC 8305)
+CONNECTION_ATTEMPT_DELAY = 0.25
+CONNECT_TIMEOUT = 10.0
+IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+class ConnectionClosed(ConnectionError):
+    pass
+
+
+def interleave(addresses: list[Address]) -> list[Address]:
+    # Alternate address families, starting with the resolver's first choice,
+    # so a broken IPv6 or IPv4 route only costs one attempt delay
+    if not addresses:
+        return []
+    first = addresses[0][0]
+    preferred = [address for address in addresses if address[0] == first]
+    others = [address for address in addresses if address[0] != first]
+    ordered: list[Address] = []
+    for i in range(max(len(preferred), len(others))):
+        ordered.extend(preferred[i : i + 1] + others[i : i + 1])
+    return ordered
+
+
+def connect_fastest(
+    addresses: list[Address],
+    timeout: float = CONNECT_TIMEOUT,
+    attempt_delay: float = CONNECTION_ATTEMPT_DELAY,
+) -> socket.socket:
+    # Happy Eyeballs: start connecting to the next address whenever the last
+    # attempt fails or hasn't finished within `attempt_delay`, and use
+    # whichever connects first
+    if not addresses:
+        raise OSError("No addresses to connect to")
+    remaining = interleave(addresses)
+    deadline = time.monotonic() + timeout
+    next_attempt = time.monotonic()
+    errors: list[OSError] = []
+    winner: socket.socket | None = None
+
+    with selectors.DefaultSelector() as attempts:
+        while winner is None and (remaining or attempts.get_map()):
+            now = time.monotonic()
+            if now >= deadline:
+                break
+
+            if remaining and (now >= next_attempt or not attempts.get_map()):
+                family, sockaddr = remaining.pop(0)
+                s = socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+                s.setblocking(False)
+                error = s.connect_ex(sockaddr)
+                if error == 0:
+                    winner = s
+                elif error in IN_PROGRESS:
+                    attempts.register(s, selectors.EVENT_WRITE, sockaddr)
+                else:
+                    errors.append(OSError(error, f"Can't connect to {sockaddr[0]}"))
+                    s.close()
+                next_attempt = now + attempt_delay
+                continue
+
+            wait = deadline if not remaining else min(deadline, next_attempt)
+            for key, _ in attempts.select(max(0, wait - now)):
+                s = key.fileobj
+                assert isinstance(s, socket.socket)
+                attempts.unregister(s)
+                error = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error == 0:
+                    winner = s
+                    break
+                errors.append(OSError(error, f"Can't connect to {key.data[0]}"))
+                s.close()
+                # Don't wait out the delay after a failure
+                next_attempt = now
+
+        # Abandon the slower attempts
+        for key in list(attempts.get_map().values()):
+            attempts.unregister(key.fileobj)
+            assert isinstance(key.fileobj, socket.socket)
+            key.fileobj.close()
+
+    if winner is None:
+        if not errors:
+            raise TimeoutError(f"Timed out connecting after {timeout}s")
+        raise errors[-1]
+    winner.setblocking(True)
+    return winner
+
+
+class Connection:
+    key: PoolKey
+    sock: socket.socket
+    # Kept for the life of the connection so read-ahead isn't lost between requests
+    file: BinaryIO
+    last_used: float
+    reused: bool
+
+    def __init__(self, key: PoolKey, sock: socket.socket):
+        self.key = key
+        self.sock = sock
+        self.file = sock.makefile("rb")
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def is_alive(self) -> bool:
+        # Nothing should arrive on an idle HTTP/1.1 connection, so if the socket
+        # is readable the server has closed it (or sent something we can't use)
+        if self.sock.fileno() == -1:
+            return False
+        if isinstance(self.sock, ssl.SSLSocket) and self.sock.pending():
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class ConnectionPool:
+    max_per_host: int
+    idle_timeout: float
+    resolver: Resolver
+    connect_timeout: float
+    idle: dict[PoolKey, list[Connection]]
+    # Number of connections per key, idle or in use
+    open: dict[PoolKey, int]
+    sessions: dict[PoolKey, ssl.SSLSession]
+    hits: int
+    misses: int
+    stale: int
+
+    def __init__(
+        self,
+        max_per_host: int = 6,
+        idle_timeout: float = 60.0,
+        resolver: Resolver | None = None,
+        connect_timeout: float = CONNECT_TIMEOUT,
+    ):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.resolver = resolver if resolver is not None else Resolver()
+        self.connect_timeout = connect_timeout
+        self.idle = {}
+        self.open = {}
+        self.sessions = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.ssl_context = ssl.create_default_context()
+        self.lock = threading.Condition()
+
+    def acquire(self, key: PoolKey, reuse: bool = True) -> Connection:
+        with self.lock:
+            self.evict_idle()
+            while True:
+                # Looked up again after every wait, as `release` may have
+                # created the list or returned a connection to it meanwhile
+                idle = self.idle.get(key, [])
+                while reuse and idle:
+                    # Take the most recently used connection, the likeliest to
+                    # be alive
+                    connection = idle.pop()
+                    if connection.is_alive():
+                        self.hits += 1
+                        tracing.count("connection reused")
+                        connection.reused = True
+                        return connection
+                    self.stale += 1
+                    self.drop(connection)
+
+                if self.open.get(key, 0) < self.max_per_host:
+                    break
+                if idle:
+                    # Not reusing, so make room by closing an idle connection
+                    self.drop(idle.pop(0))
+                else:
+                    self.lock.wait()
+
+            self.misses += 1
+            tracing.count("connection opened")
+            self.open[key] = self.open.get(key, 0) + 1
+
+        try:
+            with tracing.span("connect", "network", host=key[1]):
+                return Connection(key, self.connect(key))
+        except BaseException:
+            with self.lock:
+                self.open[key] -= 1
+                self.lock.notify_all()
+            raise
+
+    def connect(self, key: PoolKey) -> socket.socket:
+        scheme, host, port = key
+        with tracing.span("dns", "network", host=host):
+            addresses = self.resolver.resolve(host, port)
+        try:
+            s = connect_fastest(addresses, self.connect_timeout)
+        except OSError:
+            # The host may have moved, so look it up again next time
+            self.resolver.forget(host, port)
+            raise
+
+        if scheme == "https":
+            # Resume the last TLS session with this server to skip a full handshake
+            with tracing.span("tls", "network"):
+                s = self.ssl_context.wrap_socket(
+                    s, server_hostname=host, session=self.sessions.get(key)
+                )
+            if s.session is not None:
+                with self.lock:
+                    self.sessions[key] = s.session
+        return s
+
+    def release(self, connection: Connection, reusable: bool = True):
+        with self.lock:
+            idle = self.idle.setdefault(connection.key, [])
+            if reusable and connection.sock.fileno() != -1:
+                connection.last_used = time.monotonic()
+                idle.append(connection)
+                # Waiters for every host share the condition
+                self.lock.notify_all()
+            else:
+                self.drop(connection)
+
+    def discard(self, connection: Connection):
+        self.release(connection, reusable=False)
+
+    def drop(self, connection: Connection):
+        # Must be called with the lock held
+        connection.close()
+        self.open[connection.key] -= 1
+        self.lock.notify_all()
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for connections in self.idle.values():
+            while connections and connections[0].last_used < deadline:
+                self.drop(connections.pop(0))
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "idle": sum(len(idle) for idle in self.idle.values()),
+                "open": sum(self.open.values()),
+            }
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                while connections:
+                    self.drop(connections.pop())
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Iterator
+
+from response_body import read_file
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "slama", "http")
+INDEX_VERSION = 1
+
+
+@dataclass
+class CacheEntry:
+    url: str
+    filename: str
+    size: int
+    # Response headers, including the content-encoding of the stored body
+    headers: dict[str, str]
+    expires: float
+
+
+class CacheWriter:
+    # Streams a body to a temporary file, which only replaces the cached body
+    # once the whole response has been written
+    def __init__(self, cache: "DiskCache", url: str):
+        self.cache = cache
+        self.url = url
+        # Every version of a body gets a file of its own, so replacing it never
+        # changes the file under a reader of the previous version
+        fd, self.path = tempfile.mkstemp(
+            dir=cache.directory, prefix=cache.filename(url) + "-", suffix=".tmp"
+        )
+        self.filename = os.path.basename(self.path).removesuffix(".tmp")
+        self.file = os.fdopen(fd, "wb")
+        self.size = 0
+        self.failed = False
+
+    def write(self, data: bytes | memoryview):
+        if self.failed:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_bytes:
+            # Too big to ever fit, so don't bother keeping the rest
+            self.abort()
+            return
+        self.file.write(data)
+
+    def commit(self, headers: dict[str, str], expires: float):
+        if self.failed:
+            return
+        self.file.close()
+        entry = CacheEntry(self.url, self.filename, self.size, headers, expires)
+        self.cache.add(entry, self.path)
+
+    def abort(self):
+        self.failed = True
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class DiskCache:
+    directory: str
+    max_bytes: int
+    mmap_threshold: int
+    # Least recently used first
+    index: OrderedDict[str, CacheEntry]
+    size: int
+
+    def __init__(
+        self,
+        directory: str = CACHE_DIR,
+        max_bytes: int = 256 * 1024 * 1024,
+        mmap_threshold: int = 1024 * 1024,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mmap_threshold = mmap_threshold
+        self.index = OrderedDict()
+        self.size = 0
+        self.dirty = False
+        self.lock = threading.RLock()
+        self.load_index()
+
+    def index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    def filename(self, url: str):
+        return hashlib.sha256(url.encode("utf8")).hexdigest()
+
+    def load_index(self):
+        try:
+            with open(self.index_path(), encoding="utf8") as f:
+                data = json.load(f)
+            if data.get("version") != INDEX_VERSION:
+                raise ValueError("Unsupported cache index version")
+            entries = [CacheEntry(**fields) for fields in data["entries"]]
+        except (OSError, ValueError, AttributeError, KeyError, TypeError):
+            # Missing, damaged or written by another version, so start over
+            entries = []
+
+        for entry in entries:
+            # Skip entries whose body went missing, e.g. a crash mid-eviction
+            if os.path.exists(os.path.join(self.directory, entry.filename)):
+                self.index[entry.url] = entry
+                self.size += entry.size
+        self.remove_unreferenced()
+        self.evict(0)
+
+    def remove_unreferenced(self):
+        # The index is only saved on exit, so after a crash the bodies stored
+        # since, and any partly written ones, aren't in it. Deleting them keeps
+        # the directory within `max_bytes`.
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        referenced = {entry.filename for entry in self.index.values()}
+        referenced.add(os.path.basename(self.index_path()))
+        for name in names:
+            if name not in referenced:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def save_index(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            data = {
+                "version": INDEX_VERSION,
+                "entries": [asdict(entry) for entry in self.index.values()],
+            }
+            path = self.index_path()
+            with open(path + ".tmp", "w", encoding="utf8") as f:
+                json.dump(data, f)
+            os.replace(path + ".tmp", path)
+            self.dirty = False
+
+    def get(self, url: str) -> CacheEntry | None:
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is not None:
+                self.index.move_to_end(url)
+                self.dirty = True
+            return entry
+
+    def read(self, entry: CacheEntry) -> Iterator[bytes] | None:
+        # None if the body was replaced or evicted since `entry` was looked up
+        path = os.path.join(self.directory, entry.filename)
+        try:
+            return read_file(path, self.mmap_threshold)
+        except FileNotFoundError:
+            return None
+
+    def writer(self, url: str) -> CacheWriter:
+        os.makedirs(self.directory, exist_ok=True)
+        return CacheWriter(self, url)
+
+    def add(self, entry: CacheEntry, path: str):
+        with self.lock:
+            self.remove(entry.url)
+            self.evict(entry.size)
+            os.replace(path, os.path.join(self.directory, entry.filename))
+            self.index[entry.url] = entry
+            self.size += entry.size
+            self.dirty = True
+
+    def update(self, entry: CacheEntry):
+        # Replaces an entry's headers and expiry, keeping its body
+        with self.lock:
+            if entry.url in self.index:
+                self.index[entry.url] = entry
+                self.index.move_to_end(entry.url)
+                self.dirty = True
+
+    def remove(self, url: str):
+        with self.lock:
+            entry = self.index.pop(url, None)
+            if entry is None:
+                return
+            self.size -= entry.size
+            self.dirty = True
+            try:
+                os.remove(os.path.join(self.directory, entry.filename))
+            except FileNotFoundError:
+                pass
+
+    def evict(self, incoming: int):
+        # Drop least recently used entries until `incoming` more bytes fit
+        with self.lock:
+            while self.index and self.size + incoming > self.max_bytes:
+                self.remove(next(iter(self.index)))
+
+    def clear(self):
+        with self.lock:
+            for url in list(self.index):
+                self.remove(url)
+            self.save_index()
@@ -1,13 +1,28 @@
-import tkinter.font
-from typing import Literal, NamedTuple, TypeAlias
+from __future__ import annotations
+
+import struct
+import sys
+from array import array
+from typing import (
+    Iterable,
+    Iterator,
+    Literal,
+    NamedTuple,
+    TypeAlias,
+    get_args,
+    overload,
+)
+
+from font_cache import FontCacheEntry, FontStyle, FontWeight, font_entry, font_id
 
 Positioning: TypeAlias = Literal["normal", "superscript", "subscript"]
+Alignment: TypeAlias = Literal["left", "center", "right"]
 
 
 class PendingDisplayItem(NamedTuple):
     x: int
     text: str
-    font: tkinter.font.Font
+    font: FontCacheEntry
     positioning: Positioning
 
 
@@ -15,4 +30,313 @@ class DisplayItem(NamedTuple):
     x: int
     y: int
     text: str
-    font: tkinter.font.Font
+    font: FontCacheEntry
+
+
+DISPLAY_LIST_MAGIC = b"SLDL"
+DISPLAY_LIST_VERSION = 1
+# Magic, version, number of items, strings and fonts
+HEADER = struct.Struct("<4sHIII")
+# Font id, size, weight and style
+FONT_RECORD = struct.Struct("<iiBB")
+WEIGHTS: tuple[FontWeight, ...] = get_args(FontWeight)
+STYLES: tuple[FontStyle, ...] = get_args(FontStyle)
+
+
+def font_records(ids: Iterable[int]) -> list[bytes]:
+    # Font ids are only meaningful within a process, so the fonts used are
+    # written out and mapped to local ids again by `read_font_records`
+    return [
+        FONT_RECORD.pack(
+            id,
+            font_entry(id).size,
+            WEIGHTS.index(font_entry(id).weight),
+            STYLES.index(font_entry(id).style),
+        )
+        for id in sorted(set(ids))
+    ]
+
+
+def read_font_records(view: memoryview, offset: int, count: int) -> dict[int, int]:
+    ids: dict[int, int] = {}
+    for _ in range(count):
+        id, size, weight, style = FONT_RECORD.unpack_from(view, offset)
+        offset += FONT_RECORD.size
+        ids[id] = font_id(FontCacheEntry(size, WEIGHTS[weight], STYLES[style]))
+    return ids
+
+
+class DisplayList:
+    # Items are stored column by column: positions in int arrays, text as ids
+    # into a table of distinct strings and fonts as ids from `font_cache`.
+    # Indexing and iterating still produce `DisplayItem`s.
+    xs: array[int]
+    ys: array[int]
+    text_ids: array[int]
+    font_ids: array[int]
+    texts: list[str]
+    text_index: dict[str, int]
+
+    def __init__(self):
+        self.xs = array("i")
+        self.ys = array("i")
+        self.text_ids = array("i")
+        self.font_ids = array("i")
+        self.texts = []
+        self.text_index = {}
+
+    def append(self, x: int, y: int, text: str, font: FontCacheEntry):
+        text_id = self.text_index.get(text)
+        if text_id is None:
+            text_id = self.text_index[text] = len(self.texts)
+            self.texts.append(text)
+        self.xs.append(x)
+        self.ys.append(y)
+        self.text_ids.append(text_id)
+        self.font_ids.append(font_id(font))
+
+    def __len__(self):
+        return len(self.xs)
+
+    def memory_usage(self) -> int:
+        columns = [self.xs, self.ys, self.text_ids, self.font_ids]
+        size = sum(sys.getsizeof(column) for column in columns)
+        size += sys.getsizeof(self.texts) + sys.getsizeof(self.text_index)
+        return size + sum(map(sys.getsizeof, self.texts))
+
+    @overload
+    def __getitem__(self, i: int) -> DisplayItem: ...
+
+    @overload
+    def __getitem__(self, i: slice) -> list[DisplayItem]: ...
+
+    def __getitem__(self, i: int | slice):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return DisplayItem(
+            self.xs[i],
+            self.ys[i],
+            self.texts[self.text_ids[i]],
+            font_entry(self.font_ids[i]),
+        )
+
+    def __iter__(self) -> Iterator[DisplayItem]:
+        texts = self.texts
+        for x, y, text_id, id in zip(self.xs, self.ys, self.text_ids, self.font_ids):
+            yield DisplayItem(x, y, texts[text_id], font_entry(id))
+
+    def serialize(self) -> bytes:
+        fonts = font_records(self.font_ids)
+        encoded = [text.encode("utf8") for text in self.texts]
+        lengths = array("i", [len(text) for text in encoded])
+        columns = [self.xs, self.ys, self.text_ids, self.font_ids, lengths]
+        if sys.byteorder == "big":
+            columns = [array("i", column) for column in columns]
+            for column in columns:
+                column.byteswap()
+
+        header = HEADER.pack(
+            DISPLAY_LIST_MAGIC,
+            DISPLAY_LIST_VERSION,
+            len(self),
+            len(self.texts),
+            len(fonts),
+        )
+        return b"".join(
+            [header, *fonts, *(column.tobytes() for column in columns), *encoded]
+        )
+
+    @classmethod
+    def deserialize(cls, data: bytes | memoryview):
+        view = memoryview(data)
+        magic, version, items, strings, fonts = HEADER.unpack_from(view)
+        if magic != DISPLAY_LIST_MAGIC or version != DISPLAY_LIST_VERSION:
+            raise ValueError("Not a display list, or an unsupported version")
+        ids = read_font_records(view, HEADER.size, fonts)
+        offset = HEADER.size + fonts * FONT_RECORD.size
+
+        def column(length: int):
+            nonlocal offset
+            values = array("i")
+            values.frombytes(view[offset : offset + length * values.itemsize])
+            offset += length * values.itemsize
+            if sys.byteorder == "big":
+                values.byteswap()
+            return values
+
+        display_list = cls()
+        display_list.xs = column(items)
+        display_list.ys = column(items)
+        display_list.text_ids = column(items)
+        display_list.font_ids = array("i", [ids[id] for id in column(items)])
+        for length in column(strings):
+            display_list.texts.append(str(view[offset : offset + length], "utf8"))
+            offset += length
+        display_list.text_index = {text: i for i, text in enumerate(display_list.texts)}
+        return display_list
+
+
+# A measured word, ready to be placed on a line. `part_widths` holds the running
+# widths of the word's soft-hyphen separated parts, used to break it across lines.
+class WordRun(NamedTuple):
+    text: str
+    font: FontCacheEntry
+    width: int
+    space_width: int
+    hyphen_width: int
+    part_widths: tuple[int, ...]
+    positioning: Positioning
+    alignment: Alignment
+
+
+class LineBreak(NamedTuple):
+    alignment: Alignment
+
+
+class VerticalGap(NamedTuple):
+    height: int
+
+
+Run: TypeAlias = WordRun | LineBreak | VerticalGap
+
+RUNS_MAGIC = b"SLRN"
+RUNS_VERSION = 1
+# Magic, version, number of runs, word parts, strings and fonts
+RUNS_HEADER = struct.Struct("<4sHIIII")
+WORD, LINE_BREAK, VERTICAL_GAP = 0, 1, 2
+POSITIONINGS: tuple[Positioning, ...] = get_args(Positioning)
+ALIGNMENTS: tuple[Alignment, ...] = get_args(Alignment)
+
+
+def serialize_runs(runs: list[Run]) -> bytes:
+    # Measured runs, column by column like a display list, so another process
+    # can break them into lines at a new width without parsing and measuring
+    # the page again. Every run has an entry in each column.
+    kinds, positionings, alignments = array("b"), array("b"), array("b")
+    # Width of words and height of gaps
+    sizes = array("i")
+    text_ids, font_ids = array("i"), array("i")
+    space_widths, hyphen_widths = array("i"), array("i")
+    part_counts, part_widths = array("i"), array("i")
+    texts: list[str] = []
+    text_index: dict[str, int] = {}
+    for run in runs:
+        match run:
+            case WordRun():
+                text_id = text_index.get(run.text)
+                if text_id is None:
+                    text_id = text_index[run.text] = len(texts)
+                    texts.append(run.text)
+                kinds.append(WORD)
+                sizes.append(run.width)
+                text_ids.append(text_id)
+                font_ids.append(font_id(run.font))
+                space_widths.append(run.space_width)
+                hyphen_widths.append(run.hyphen_width)
+                part_counts.append(len(run.part_widths))
+                part_widths.extend(run.part_widths)
+                positionings.append(POSITIONINGS.index(run.positioning))
+                alignments.append(ALIGNMENTS.index(run.alignment))
+                continue
+            case LineBreak(alignment):
+                kinds.append(LINE_BREAK)
+                sizes.append(0)
+                alignments.append(ALIGNMENTS.index(alignment))
+            case VerticalGap(height):
+                kinds.append(VERTICAL_GAP)
+                sizes.append(height)
+                alignments.append(0)
+        for column in (text_ids, font_ids, space_widths, hyphen_widths, part_counts):
+            column.append(0)
+        positionings.append(0)
+
+    fonts = font_records(font_ids)
+    encoded = [text.encode("utf8") for text in texts]
+    lengths = array("i", [len(text) for text in encoded])
+    columns = [
+        sizes,
+        text_ids,
+        font_ids,
+        space_widths,
+        hyphen_widths,
+        part_counts,
+        part_widths,
+        lengths,
+    ]
+    if sys.byteorder == "big":
+        columns = [array("i", column) for column in columns]
+        for column in columns:
+            column.byteswap()
+
+    header = RUNS_HEADER.pack(
+        RUNS_MAGIC, RUNS_VERSION, len(runs), len(part_widths), len(texts), len(fonts)
+    )
+    return b"".join(
+        [
+            header,
+            *fonts,
+            *(column.tobytes() for column in [kinds, positionings, alignments]),
+            *(column.tobytes() for column in columns),
+            *encoded,
+        ]
+    )
+
+
+def deserialize_runs(data: bytes | memoryview) -> list[Run]:
+    view = memoryview(data)
+    magic, version, count, parts, strings, fonts = RUNS_HEADER.unpack_from(view)
+    if magic != RUNS_MAGIC or version != RUNS_VERSION:
+        raise ValueError("Not a list of runs, or an unsupported version")
+    entries = {
+        id: font_entry(local)
+        for id, local in read_font_records(view, RUNS_HEADER.size, fonts).items()
+    }
+    offset = RUNS_HEADER.size + fonts * FONT_RECORD.size
+
+    def column(typecode: str, length: int):
+        nonlocal offset
+        values = array(typecode)
+        values.frombytes(view[offset : offset + length * values.itemsize])
+        offset += length * values.itemsize
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    kinds = column("b", count)
+    positionings = column("b", count)
+    alignments = column("b", count)
+    sizes = column("i", count)
+    text_ids = column("i", count)
+    font_ids = column("i", count)
+    space_widths = column("i", count)
+    hyphen_widths = column("i", count)
+    part_counts = column("i", count)
+    part_widths = column("i", parts)
+    texts: list[str] = []
+    for length in column("i", strings):
+        texts.append(str(view[offset : offset + length], "utf8"))
+        offset += length
+
+    runs: list[Run] = []
+    part = 0
+    for i, kind in enumerate(kinds):
+        if kind == WORD:
+            end = part + part_counts[i]
+            runs.append(
+                WordRun(
+                    texts[text_ids[i]],
+                    entries[font_ids[i]],
+                    sizes[i],
+                    space_widths[i],
+                    hyphen_widths[i],
+                    tuple(part_widths[part:end]),
+                    POSITIONINGS[positionings[i]],
+                    ALIGNMENTS[alignments[i]],
+                )
+            )
+            part = end
+        elif kind == LINE_BREAK:
+            runs.append(LineBreak(ALIGNMENTS[alignments[i]]))
+        else:
+            runs.append(VerticalGap(sizes[i]))
+    return runs
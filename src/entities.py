@@ -1,3 +1,6 @@
+import re
+from functools import cache
+
 entities: dict[str, str] = {
     "&lt;": "<",
     "&gt;": ">",
@@ -39,3 +42,45 @@ entities: dict[str, str] = {
     "&frac34;": "¾",
     "&shy;": "\N{SOFT HYPHEN}",
 }
+
+ENTITY_PATTERN = re.compile(
+    r"&(?:#([0-9]+)|#[xX]([0-9a-fA-F]+)|([A-Za-z][A-Za-z0-9]*));"
+)
+
+# Everything `entities` names, except spaces which are left alone in view-source
+ENCODE_TABLE = str.maketrans(
+    {char: entity for entity, char in entities.items() if char != " "}
+)
+
+
+@cache
+def named_entities() -> dict[str, str]:
+    # The full HTML5 table has over 2000 entries, so only load it when a page
+    # uses an entity that isn't in the short table above
+    from html.entities import html5
+
+    return html5
+
+
+def replace_entity(match: re.Match[str]) -> str:
+    decimal, hexadecimal, name = match.groups()
+    if name is not None:
+        entity = match.group(0)
+        if entity in entities:
+            return entities[entity]
+        return named_entities().get(name + ";", entity)
+
+    codepoint = int(decimal, 10) if decimal is not None else int(hexadecimal, 16)
+    if codepoint == 0 or codepoint > 0x10FFFF or 0xD800 <= codepoint <= 0xDFFF:
+        return "\N{REPLACEMENT CHARACTER}"
+    return chr(codepoint)
+
+
+def decode(text: str) -> str:
+    if "&" not in text:
+        return text
+    return ENTITY_PATTERN.sub(replace_entity, text)
+
+
+def encode(text: str) -> str:
+    return text.translate(ENCODE_TABLE)
@@ -1,6 +1,12 @@
+import json
+import os
+import string
 import tkinter.font
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Literal, TypeAlias
+from typing import Literal, NamedTuple, Protocol, TypeAlias
+
+import tracing
 
 FontWeight: TypeAlias = Literal["normal", "bold"]
 FontStyle: TypeAlias = Literal["roman", "italic"]
@@ -13,7 +19,41 @@ class FontCacheEntry:
     style: FontStyle
 
 
+class LineMetrics(NamedTuple):
+    ascent: int
+    descent: int
+    linespace: int
+
+
+# Per-font values layout needs for every word and line
+class FontMetrics(NamedTuple):
+    ascent: int
+    descent: int
+    linespace: int
+    space_width: int
+    hyphen_width: int
+
+
+# Everything layout needs to know about text, so it can run against Tk or
+# against precomputed tables when there is no display.
+class TextMetrics(Protocol):
+    name: str
+
+    def measure(self, font: FontCacheEntry, text: str) -> int: ...
+
+    def metrics(self, font: FontCacheEntry) -> LineMetrics: ...
+
+
 FONTS: dict[FontCacheEntry, tuple[tkinter.font.Font, tkinter.Label]] = {}
+# Small integer ids for fonts, so display lists can keep them in arrays
+FONT_IDS: dict[FontCacheEntry, int] = {}
+FONT_ENTRIES: list[FontCacheEntry] = []
+
+WIDTH_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "slama", "widths.json"
+)
+WIDTH_CACHE_VERSION = 1
+GLYPH_TABLE_VERSION = 1
 
 
 def get_font(size: int, weight: FontWeight, style: FontStyle):
@@ -23,3 +63,266 @@ def get_font(size: int, weight: FontWeight, style: FontStyle):
         label = tkinter.Label(font=font)
         FONTS[key] = (font, label)
     return FONTS[key][0]
+
+
+def font_id(font: FontCacheEntry) -> int:
+    id = FONT_IDS.get(font)
+    if id is None:
+        id = FONT_IDS[font] = len(FONT_ENTRIES)
+        FONT_ENTRIES.append(font)
+    return id
+
+
+def font_entry(id: int) -> FontCacheEntry:
+    return FONT_ENTRIES[id]
+
+
+class TkTextMetrics:
+    # Requires a Tk root (and so a display)
+    name = "tk"
+
+    def measure(self, font: FontCacheEntry, text: str) -> int:
+        tracing.count("tk measure")
+        return get_font(font.size, font.weight, font.style).measure(text)
+
+    def metrics(self, font: FontCacheEntry) -> LineMetrics:
+        tracing.count("tk metrics")
+        metrics = get_font(font.size, font.weight, font.style).metrics()
+        return LineMetrics(metrics["ascent"], metrics["descent"], metrics["linespace"])
+
+
+class GlyphTable(NamedTuple):
+    # Advances and vertical metrics at `TableTextMetrics.size`
+    advances: dict[str, float]
+    default_advance: float
+    ascent: float
+    descent: float
+    linespace: float
+
+
+class TableTextMetrics:
+    # Pure Python metrics from per-glyph advance tables, measured once at a
+    # reference size (usually with `from_backend` under Tk) and scaled linearly.
+    name: str
+    size: int
+    tables: dict[tuple[FontWeight, FontStyle], GlyphTable]
+
+    def __init__(
+        self,
+        size: int,
+        tables: dict[tuple[FontWeight, FontStyle], GlyphTable],
+        name: str = "table",
+    ):
+        self.size = size
+        self.tables = tables
+        self.name = name
+
+    @classmethod
+    def from_backend(
+        cls,
+        backend: TextMetrics,
+        size: int = 16,
+        characters: str = string.printable
+        + "".join(chr(c) for c in range(0xA0, 0x180)),
+    ):
+        tables: dict[tuple[FontWeight, FontStyle], GlyphTable] = {}
+        weights: list[FontWeight] = ["normal", "bold"]
+        styles: list[FontStyle] = ["roman", "italic"]
+        for weight in weights:
+            for style in styles:
+                font = FontCacheEntry(size, weight, style)
+                advances = {c: float(backend.measure(font, c)) for c in characters}
+                ascent, descent, linespace = backend.metrics(font)
+                tables[(weight, style)] = GlyphTable(
+                    advances,
+                    sum(advances.values()) / len(advances),
+                    ascent,
+                    descent,
+                    linespace,
+                )
+        return cls(size, tables, f"table:{backend.name}")
+
+    @classmethod
+    def approximate(cls, size: int = 16):
+        # Rough proportional metrics for when no measured table is available
+        tables: dict[tuple[FontWeight, FontStyle], GlyphTable] = {}
+        weights: list[tuple[FontWeight, float]] = [("normal", 1.0), ("bold", 1.08)]
+        styles: list[FontStyle] = ["roman", "italic"]
+        for weight, scale in weights:
+            for style in styles:
+                advances = {c: 0.3 * size for c in " .,:;'!|il"}
+                advances.update({c: 0.8 * size * scale for c in "MWmw"})
+                tables[(weight, style)] = GlyphTable(
+                    advances, 0.55 * size * scale, 0.8 * size, 0.2 * size, size
+                )
+        return cls(size, tables, "approximate")
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, encoding="utf8") as f:
+            data = json.load(f)
+        if data.get("version") != GLYPH_TABLE_VERSION:
+            raise ValueError(f"Unsupported glyph table version in {path}")
+
+        tables: dict[tuple[FontWeight, FontStyle], GlyphTable] = {}
+        for table in data["tables"]:
+            tables[(table["weight"], table["style"])] = GlyphTable(
+                table["advances"],
+                table["default_advance"],
+                table["ascent"],
+                table["descent"],
+                table["linespace"],
+            )
+        return cls(data["size"], tables, data["name"])
+
+    def save(self, path: str):
+        tables = [
+            {"weight": weight, "style": style, **table._asdict()}
+            for (weight, style), table in self.tables.items()
+        ]
+        data = {
+            "version": GLYPH_TABLE_VERSION,
+            "name": self.name,
+            "size": self.size,
+            "tables": tables,
+        }
+        with open(path, "w", encoding="utf8") as f:
+            json.dump(data, f)
+
+    def measure(self, font: FontCacheEntry, text: str) -> int:
+        table = self.tables[(font.weight, font.style)]
+        advances = table.advances
+        default = table.default_advance
+        width = sum([advances.get(c, default) for c in text])
+        return round(width * font.size / self.size)
+
+    def metrics(self, font: FontCacheEntry) -> LineMetrics:
+        table = self.tables[(font.weight, font.style)]
+        scale = font.size / self.size
+        return LineMetrics(
+            round(table.ascent * scale),
+            round(table.descent * scale),
+            round(table.linespace * scale),
+        )
+
+
+class WidthCache:
+    # Memoizes text widths so each (font, string) pair is only measured once by
+    # the backend, evicting the least recently used entries beyond `max_entries`.
+    # Per-font metrics are few and never change, so they are kept for good.
+    backend: TextMetrics
+    entries: OrderedDict[tuple[FontCacheEntry, str], int]
+    fonts: dict[FontCacheEntry, FontMetrics]
+    max_entries: int
+    hits: int
+    misses: int
+
+    def __init__(self, backend: TextMetrics, max_entries: int = 100_000):
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.fonts = {}
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    def measure(self, font: FontCacheEntry, text: str) -> int:
+        key = (font, text)
+        width = self.entries.get(key)
+        if width is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return width
+
+        self.misses += 1
+        width = self.backend.measure(font, text)
+        self.insert(key, width)
+        return width
+
+    def metrics(self, font: FontCacheEntry) -> LineMetrics:
+        ascent, descent, linespace, _, _ = self.font_metrics(font)
+        return LineMetrics(ascent, descent, linespace)
+
+    def font_metrics(self, font: FontCacheEntry) -> FontMetrics:
+        metrics = self.fonts.get(font)
+        if metrics is None:
+            ascent, descent, linespace = self.backend.metrics(font)
+            metrics = self.fonts[font] = FontMetrics(
+                ascent,
+                descent,
+                linespace,
+                self.backend.measure(font, " "),
+                self.backend.measure(font, "-"),
+            )
+        return metrics
+
+    def insert(self, key: tuple[FontCacheEntry, str], width: int):
+        self.entries[key] = width
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "fonts": len(self.fonts),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def clear(self):
+        self.entries.clear()
+        self.fonts.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def save(self, path: str = WIDTH_CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        entries = [
+            [font.size, font.weight, font.style, text, width]
+            for (font, text), width in self.entries.items()
+        ]
+        data = {
+            "version": WIDTH_CACHE_VERSION,
+            "backend": self.backend.name,
+            "entries": entries,
+        }
+        # Write to a temporary file first so a crash can't leave a torn cache
+        with open(path + ".tmp", "w", encoding="utf8") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+
+    def load(self, path: str = WIDTH_CACHE_PATH) -> bool:
+        try:
+            with open(path, encoding="utf8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        # Widths measured by a different backend don't apply
+        if (
+            data.get("version") != WIDTH_CACHE_VERSION
+            or data.get("backend") != self.backend.name
+        ):
+            return False
+
+        # Entries are saved least recently used first, so inserting them in
+        # order keeps the most useful ones if the file exceeds `max_entries`
+        for size, weight, style, text, width in data["entries"]:
+            self.insert((FontCacheEntry(size, weight, style), text), width)
+        return True
+
+
+WIDTHS = WidthCache(TkTextMetrics())
+
+
+def set_backend(backend: TextMetrics):
+    WIDTHS.backend = backend
+    WIDTHS.clear()
+
+
+def measure(font: FontCacheEntry, text: str) -> int:
+    return WIDTHS.measure(font, text)
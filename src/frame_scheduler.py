@@ -0,0 +1,97 @@
+import time
+import tkinter
+from typing import Callable
+
+import tracing
+
+FRAME_INTERVAL = 1 / 60
+RESIZE_DEBOUNCE_MS = 100
+
+
+class FrameScheduler:
+    # Runs `draw` at most once per frame, once Tk has handled the pending
+    # events, however many events asked for a redraw in the meantime
+    window: tkinter.Misc
+    draw: Callable[[], None]
+    scheduled: bool
+    # Redraws requested since the last frame
+    requested: int
+    requested_at: float
+    last_frame: float
+    frames: int
+    # Requests merged into an already scheduled frame
+    coalesced: int
+    # Frame intervals that passed without a frame while one was due
+    dropped: int
+
+    def __init__(self, window: tkinter.Misc, draw: Callable[[], None]):
+        self.window = window
+        self.draw = draw
+        self.scheduled = False
+        self.requested = 0
+        self.requested_at = 0.0
+        self.last_frame = 0.0
+        self.frames = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def request(self):
+        self.requested += 1
+        if self.scheduled:
+            return
+        self.scheduled = True
+        now = time.perf_counter()
+        self.requested_at = now
+        wait = self.last_frame + FRAME_INTERVAL - now
+        if wait > 0:
+            # Too soon after the last frame
+            self.window.after(max(1, round(wait * 1000)), self.run)
+        else:
+            self.window.after_idle(self.run)
+
+    def run(self):
+        now = time.perf_counter()
+        due = max(self.requested_at, self.last_frame + FRAME_INTERVAL)
+        self.dropped += int((now - due) // FRAME_INTERVAL)
+        self.coalesced += self.requested - 1
+        self.frames += 1
+        self.requested = 0
+        self.scheduled = False
+        self.last_frame = now
+        self.draw()
+        tracing.sample("frames", self.stats())
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "frames": self.frames,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+        }
+
+
+class Debouncer:
+    # Calls `action` once no call to `trigger` has happened for `delay_ms`
+    window: tkinter.Misc
+    action: Callable[[], None]
+    delay_ms: int
+    pending: str | None
+
+    def __init__(
+        self,
+        window: tkinter.Misc,
+        action: Callable[[], None],
+        delay_ms: int = RESIZE_DEBOUNCE_MS,
+    ):
+        self.window = window
+        self.action = action
+        self.delay_ms = delay_ms
+        self.pending = None
+
+    def trigger(self):
+        if self.pending is not None:
+            self.window.after_cancel(self.pending)
+        self.pending = self.window.after(self.delay_ms, self.run)
+
+    def run(self):
+        self.pending = None
+        self.action()
@@ -0,0 +1,159 @@
+import threading
+from collections import OrderedDict
+
+from html_parser import Element, Text
+from layout import Layout
+from layout_worker import RemoteLayout
+from snapshot import SnapshotLayout
+from url import URL
+
+HISTORY_MAX_BYTES = 64 * 1024 * 1024
+DOCUMENTS_MAX_BYTES = 32 * 1024 * 1024
+
+
+class HistoryEntry:
+    url: URL
+    scroll: int
+    # The page as last shown, while it fits in the history's memory budget
+    layout: Layout | RemoteLayout | SnapshotLayout | None
+    # Hash of the page's source, to find its document in a DocumentCache
+    content_hash: str | None
+    size: int
+
+    def __init__(self, url: URL):
+        self.url = url
+        self.scroll = 0
+        self.layout = None
+        self.content_hash = None
+        self.size = 0
+
+
+def document_usage(layout: Layout | RemoteLayout | SnapshotLayout) -> int:
+    # A layout keeps its document alive, which stops counting towards the
+    # DocumentCache's budget once that drops it
+    if isinstance(layout, Layout):
+        root = layout.root
+    elif isinstance(layout, SnapshotLayout):
+        root = layout.document
+    else:
+        return 0
+    return root.store.memory_usage() if root is not None else 0
+
+
+class History:
+    # The back/forward stack. Entries keep their layout so revisiting them
+    # doesn't fetch, parse or lay out the page again, dropping the least
+    # recently shown ones' layouts beyond `max_bytes`.
+    entries: list[HistoryEntry]
+    index: int
+    max_bytes: int
+    # Entries holding a layout, least recently shown first
+    cached: OrderedDict[HistoryEntry, None]
+    size: int
+
+    def __init__(self, max_bytes: int = HISTORY_MAX_BYTES):
+        self.entries = []
+        self.index = -1
+        self.max_bytes = max_bytes
+        self.cached = OrderedDict()
+        self.size = 0
+
+    @property
+    def current(self) -> HistoryEntry | None:
+        return self.entries[self.index] if self.index >= 0 else None
+
+    def visit(self, url: URL) -> HistoryEntry:
+        # Visiting a new page drops everything ahead of the current one
+        for entry in self.entries[self.index + 1 :]:
+            self.drop(entry)
+        del self.entries[self.index + 1 :]
+        entry = HistoryEntry(url)
+        self.entries.append(entry)
+        self.index += 1
+        return entry
+
+    def back(self) -> HistoryEntry | None:
+        if self.index <= 0:
+            return None
+        self.index -= 1
+        return self.show(self.entries[self.index])
+
+    def forward(self) -> HistoryEntry | None:
+        if self.index + 1 >= len(self.entries):
+            return None
+        self.index += 1
+        return self.show(self.entries[self.index])
+
+    def show(self, entry: HistoryEntry):
+        if entry in self.cached:
+            self.cached.move_to_end(entry)
+        return entry
+
+    def store(
+        self, layout: Layout | RemoteLayout | SnapshotLayout, content_hash: str | None
+    ):
+        # Keeps the finished layout of the current page
+        entry = self.current
+        if entry is None:
+            return
+        self.drop(entry)
+        entry.layout = layout
+        entry.content_hash = content_hash
+        entry.size = layout.memory_usage() + document_usage(layout)
+        self.cached[entry] = None
+        self.size += entry.size
+        self.evict()
+
+    def drop(self, entry: HistoryEntry):
+        if entry in self.cached:
+            del self.cached[entry]
+            self.size -= entry.size
+        entry.layout = None
+        entry.size = 0
+
+    def evict(self):
+        current = self.current
+        for entry in list(self.cached):
+            if self.size <= self.max_bytes:
+                break
+            # The page on screen stays, whatever its size
+            if entry is not current:
+                self.drop(entry)
+
+
+class DocumentCache:
+    # Parsed documents keyed by a hash of their source, so a page fetched
+    # again unchanged isn't parsed again. Used from the loader thread too.
+    max_bytes: int
+    # Least recently used first
+    documents: OrderedDict[str, tuple[Element | Text, int]]
+    size: int
+
+    def __init__(self, max_bytes: int = DOCUMENTS_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.documents = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, content_hash: str | None):
+        with self.lock:
+            return content_hash in self.documents
+
+    def get(self, content_hash: str) -> Element | Text | None:
+        with self.lock:
+            if content_hash not in self.documents:
+                return None
+            self.documents.move_to_end(content_hash)
+            return self.documents[content_hash][0]
+
+    def add(self, content_hash: str, root: Element | Text):
+        size = root.store.memory_usage()
+        with self.lock:
+            if content_hash in self.documents:
+                self.documents.move_to_end(content_hash)
+                return
+            self.documents[content_hash] = (root, size)
+            self.size += size
+            while len(self.documents) > 1 and self.size > self.max_bytes:
+                _, (_, evicted) = self.documents.popitem(last=False)
+                self.size -= evicted
@@ -1,44 +1,165 @@
 from __future__ import annotations
 
 import re
-from dataclasses import dataclass, field
 from enum import Enum, auto
-from typing import TypeAlias
+from typing import Literal, Mapping, NamedTuple, TypeAlias
 
+import node_store
+import tracing
+from entities import decode
+from node_store import NodeStore
 
-@dataclass(frozen=True)
+
+# Nodes are lightweight views of a NodeStore, which holds the whole document
 class Element:
-    tag: str
-    parent: Element | None = None
-    children: list[HtmlNode] = field(default_factory=list)
-    attrs: dict[str, str] = field(default_factory=dict)
+    __slots__ = ("store", "index")
+    __match_args__ = ("tag",)
+    store: NodeStore
+    index: int
+
+    def __init__(self, store: NodeStore, index: int):
+        self.store = store
+        self.index = index
+
+    @property
+    def tag(self) -> str:
+        return self.store.tag(self.index)
+
+    @property
+    def parent(self) -> Element | None:
+        return node_parent(self.store, self.index)
+
+    @property
+    def children(self) -> list[HtmlNode]:
+        return [
+            node_view(self.store, child) for child in self.store.children(self.index)
+        ]
+
+    @property
+    def attrs(self) -> Mapping[str, str]:
+        return self.store.attributes(self.index)
+
+    def __eq__(self, other: object):
+        return (
+            isinstance(other, Element)
+            and self.store is other.store
+            and self.index == other.index
+        )
+
+    def __hash__(self):
+        return hash((id(self.store), self.index))
 
     def __repr__(self):
         attrs = " ".join(f"{k}='{v}'" if v != "" else k for k, v in self.attrs.items())
         return "<" + self.tag + " " + attrs + ">"
 
 
-@dataclass(frozen=True)
 class Text:
-    text: str
-    parent: Element | None = None
+    __slots__ = ("store", "index")
+    __match_args__ = ("text",)
+    store: NodeStore
+    index: int
+
+    def __init__(self, store: NodeStore, index: int):
+        self.store = store
+        self.index = index
+
+    @property
+    def text(self) -> str:
+        return self.store.text(self.index)
+
+    @property
+    def parent(self) -> Element | None:
+        return node_parent(self.store, self.index)
+
+    def __eq__(self, other: object):
+        return (
+            isinstance(other, Text)
+            and self.store is other.store
+            and self.index == other.index
+        )
+
+    def __hash__(self):
+        return hash((id(self.store), self.index))
 
     def __repr__(self):
         return repr(self.text)
 
 
-@dataclass(frozen=True)
 class Comment:
-    text: str
-    parent: Element | None = None
+    __slots__ = ("store", "index")
+    __match_args__ = ("text",)
+    store: NodeStore
+    index: int
+
+    def __init__(self, store: NodeStore, index: int):
+        self.store = store
+        self.index = index
+
+    @property
+    def text(self) -> str:
+        return self.store.text(self.index)
+
+    @property
+    def parent(self) -> Element | None:
+        return node_parent(self.store, self.index)
+
+    def __eq__(self, other: object):
+        return (
+            isinstance(other, Comment)
+            and self.store is other.store
+            and self.index == other.index
+        )
+
+    def __hash__(self):
+        return hash((id(self.store), self.index))
 
     def __repr__(self):
         return f"<!--{self.text}-->"
 
 
+def node_view(store: NodeStore, index: int) -> HtmlNode:
+    match store.kinds[index]:
+        case node_store.ELEMENT:
+            return Element(store, index)
+        case node_store.TEXT:
+            return Text(store, index)
+        case _:
+            return Comment(store, index)
+
+
+def node_parent(store: NodeStore, index: int) -> Element | None:
+    parent = store.parents[index]
+    return Element(store, parent) if parent != node_store.NO_NODE else None
+
+
 HtmlNode: TypeAlias = Element | Text | Comment
 
 
+# Emitted as elements are opened and closed and text is added, so layout can
+# follow the document while it is still arriving
+class ParseEvent(NamedTuple):
+    kind: Literal["open", "text", "close"]
+    node: Element | Text
+
+
+def tree_events(node: HtmlNode, events: list[ParseEvent] | None = None):
+    # The events parsing `node` produced, to replay an already parsed document
+    if events is None:
+        events = []
+    match node:
+        case Element():
+            events.append(ParseEvent("open", node))
+            for child in node.children:
+                tree_events(child, events)
+            events.append(ParseEvent("close", node))
+        case Text():
+            events.append(ParseEvent("text", node))
+        case Comment():
+            pass
+    return events
+
+
 class HTMLParserState(Enum):
     TEXT = auto()
     IN_TAG = auto()
@@ -77,55 +198,137 @@ class HTMLParser:
         "script",
     ]
 
-    def __init__(self, body: str):
+    ATTRIBUTE_PATTERN = re.compile(r"(?P<key>\w+)(=(['\"])(?P<val>.*?)\3)?")
+    TAG_DELIMITERS = re.compile(r"['\">]")
+    SCRIPT_END = "</script>"
+
+    def __init__(self, body: str = "", record_events: bool = False):
         self.body = body
+        self.store = NodeStore()
         self.unfinished: list[Element] = []
+        self.events: list[ParseEvent] | None = [] if record_events else None
+        # Unconsumed input. `pos` marks the start of the token being scanned and
+        # `scan_from` where to resume looking for its end, so every character is
+        # only examined once no matter how the input is split into chunks.
+        self.buffer = ""
+        self.pos = 0
+        self.scan_from = 0
+        self.state = HTMLParserState.TEXT
+        # Chunks that can't finish the current token are queued instead of being
+        # appended, so a long token arriving in small chunks is only copied once.
+        self.queued: list[str] = []
 
     def parse(self):
-        text = ""
-        state = HTMLParserState.TEXT
-
-        for c in self.body:
-            if c == "'" and state == HTMLParserState.IN_TAG:
-                state = HTMLParserState.IN_SINGLE_QUOTED_ATTR
-                text += c
-            elif c == "'" and state == HTMLParserState.IN_SINGLE_QUOTED_ATTR:
-                state = HTMLParserState.IN_TAG
-                text += c
-            elif c == '"' and state == HTMLParserState.IN_TAG:
-                state = HTMLParserState.IN_DOUBLE_QUOTED_ATTR
-                text += c
-            elif c == '"' and state == HTMLParserState.IN_DOUBLE_QUOTED_ATTR:
-                state = HTMLParserState.IN_TAG
-                text += c
-            elif c == "<" and state == HTMLParserState.TEXT:
-                state = HTMLParserState.IN_TAG
-                if text:
-                    self.add_text(text)
-                text = ""
-            elif c == ">":
-                if state == HTMLParserState.IN_SCRIPT:
-                    if text.endswith("</script"):
-                        state = HTMLParserState.TEXT
-                        self.add_tag("script")
-                        # TODO: Handle script contents
-                        # _script_contents = text.removesuffix("</script")
-                        text = ""
-                elif state == HTMLParserState.IN_TAG:
-                    state = HTMLParserState.TEXT
-                    self.add_tag(text)
-                    if text == "script":
-                        state = HTMLParserState.IN_SCRIPT
-                    text = ""
-                else:
-                    text += c
-            else:
-                text += c
+        with tracing.span("parse", length=len(self.body)):
+            self.feed(self.body)
+            return self.close()
+
+    def feed(self, chunk: str):
+        self.queued.append(chunk)
+        if self.ends_token(chunk):
+            self.buffer = self.buffer + "".join(self.queued)
+            self.queued = []
+            with tracing.span("tokenize"):
+                self.tokenize()
+
+    def ends_token(self, chunk: str):
+        match self.state:
+            case HTMLParserState.TEXT:
+                return "<" in chunk
+            case HTMLParserState.IN_TAG:
+                return self.TAG_DELIMITERS.search(chunk) is not None
+            case HTMLParserState.IN_SINGLE_QUOTED_ATTR:
+                return "'" in chunk
+            case HTMLParserState.IN_DOUBLE_QUOTED_ATTR:
+                return '"' in chunk
+            case HTMLParserState.IN_SCRIPT:
+                return ">" in chunk
+
+    def close(self):
+        self.buffer = self.buffer + "".join(self.queued)
+        self.queued = []
+        if self.state == HTMLParserState.TEXT and self.pos < len(self.buffer):
+            self.add_text(self.buffer[self.pos :])
+        self.buffer = ""
+        self.pos = self.scan_from = 0
+        return self.finish()
 
-        if state == HTMLParserState.TEXT and text:
-            self.add_text(text)
+    def tokenize(self):
+        buffer = self.buffer
+        end = len(buffer)
+        pos = self.pos
+        scan = self.scan_from
+        state = self.state
+        TEXT = HTMLParserState.TEXT
+        IN_TAG = HTMLParserState.IN_TAG
+        IN_SCRIPT = HTMLParserState.IN_SCRIPT
+        IN_SINGLE_QUOTED_ATTR = HTMLParserState.IN_SINGLE_QUOTED_ATTR
+        IN_DOUBLE_QUOTED_ATTR = HTMLParserState.IN_DOUBLE_QUOTED_ATTR
+        find_delimiter = self.TAG_DELIMITERS.search
 
-        return self.finish()
+        while True:
+            # Enum members are bound to locals above as this loop is the hot path
+            if state is TEXT:
+                i = buffer.find("<", scan)
+                if i == -1:
+                    scan = end
+                    break
+                if i > pos:
+                    self.add_text(buffer[pos:i])
+                pos = scan = i + 1
+                state = IN_TAG
+            elif state is IN_TAG:
+                delimiter = find_delimiter(buffer, scan)
+                if delimiter is None:
+                    scan = end
+                    break
+                i = delimiter.start()
+                match delimiter.group():
+                    case "'":
+                        state = IN_SINGLE_QUOTED_ATTR
+                        scan = i + 1
+                    case '"':
+                        state = IN_DOUBLE_QUOTED_ATTR
+                        scan = i + 1
+                    case _:
+                        text = buffer[pos:i]
+                        self.add_tag(text)
+                        if text == "script":
+                            state = IN_SCRIPT
+                        else:
+                            state = TEXT
+                        pos = scan = i + 1
+            elif state is IN_SINGLE_QUOTED_ATTR:
+                i = buffer.find("'", scan)
+                if i == -1:
+                    scan = end
+                    break
+                state = IN_TAG
+                scan = i + 1
+            elif state is IN_DOUBLE_QUOTED_ATTR:
+                i = buffer.find('"', scan)
+                if i == -1:
+                    scan = end
+                    break
+                state = IN_TAG
+                scan = i + 1
+            else:
+                i = buffer.find(self.SCRIPT_END, scan)
+                if i == -1:
+                    # The end tag may be split across chunks
+                    scan = max(pos, end - len(self.SCRIPT_END) + 1)
+                    break
+                # TODO: Handle script contents
+                # _script_contents = buffer[pos:i]
+                self.add_tag("script")
+                pos = scan = i + len(self.SCRIPT_END)
+                state = TEXT
+
+        # Drop everything that has already been consumed
+        self.buffer = buffer[pos:]
+        self.pos = 0
+        self.scan_from = scan - pos
+        self.state = state
 
     def add_text(self, text: str):
         # Ignore empty text nodes
@@ -134,19 +337,14 @@ class HTMLParser:
 
         self.implicit_tags(None)
 
-        parent = self.unfinished[-1] if self.unfinished else None
-        node = Text(text, parent)
-        if parent:
-            parent.children.append(node)
+        node = Text(self.store, self.add_node(node_store.TEXT, decode(text)))
+        self.emit("text", node)
 
     def add_tag(self, text: str):
         tag, attributes = self.get_attributes(text)
 
         if tag == "!--":
-            parent = self.unfinished[-1] if self.unfinished else None
-            node = Comment(text[3:-3], parent)
-            if parent:
-                parent.children.append(node)
+            self.add_node(node_store.COMMENT, text[3:-3])
             return
 
         # Ignore DOCTYPE and comments
@@ -159,12 +357,11 @@ class HTMLParser:
             if len(self.unfinished) == 1:
                 return
             node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            self.emit("close", node)
         elif tag in self.SELF_CLOSING_TAGS:
-            parent = self.unfinished[-1]
-            node = Element(tag, parent, attrs=attributes)
-            parent.children.append(node)
+            node = self.add_element(tag, attributes)
+            self.emit("open", node)
+            self.emit("close", node)
         else:
             # Don't allow directly nested paragraphs or list items
             if (
@@ -173,20 +370,45 @@ class HTMLParser:
                 and tag in ["p", "li"]
             ):
                 node = self.unfinished.pop()
-                self.unfinished[-1].children.append(node)
+                self.emit("close", node)
 
-            parent = self.unfinished[-1] if self.unfinished else None
-            node = Element(tag, parent, attrs=attributes)
+            node = self.add_element(tag, attributes)
             self.unfinished.append(node)
+            self.emit("open", node)
+
+    def add_node(self, kind: int, text: str):
+        # Nodes are linked into the tree as soon as they are created
+        parent = self.unfinished[-1].index if self.unfinished else node_store.NO_NODE
+        index = self.store.add_text(kind, text, parent)
+        if parent != node_store.NO_NODE:
+            self.store.append_child(parent, index)
+        return index
+
+    def add_element(self, tag: str, attributes: dict[str, str]):
+        parent = self.unfinished[-1].index if self.unfinished else node_store.NO_NODE
+        index = self.store.add_element(tag, parent, attributes)
+        if parent != node_store.NO_NODE:
+            self.store.append_child(parent, index)
+        return Element(self.store, index)
+
+    def emit(self, kind: Literal["open", "text", "close"], node: Element | Text):
+        if self.events is not None:
+            self.events.append(ParseEvent(kind, node))
+
+    def take_events(self) -> list[ParseEvent]:
+        # Returns the events since the last call
+        events = self.events or []
+        if self.events is not None:
+            self.events = []
+        return events
 
     def get_attributes(self, text: str):
         components = text.split(" ", 1)
         tag = components[0]
         attr_str = components[1] if len(components) > 1 else ""
-        pattern = re.compile(r"(?P<key>\w+)(=(['\"])(?P<val>.*?)\3)?")
         attributes = {
             match.group("key"): match.group("val") or ""
-            for match in pattern.finditer(attr_str)
+            for match in self.ATTRIBUTE_PATTERN.finditer(attr_str)
         }
 
         return tag.casefold(), attributes
@@ -197,9 +419,10 @@ class HTMLParser:
 
         while len(self.unfinished) > 1:
             node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
-        return self.unfinished.pop()
+            self.emit("close", node)
+        root = self.unfinished.pop()
+        self.emit("close", root)
+        return root
 
     def print_tree(self, node: HtmlNode, indent: int = 0):
         print(" " * indent, node)
@@ -211,17 +434,25 @@ class HTMLParser:
                 pass
 
     def implicit_tags(self, tag: str | None):
+        # Only the first two open tags matter, so avoid building the whole stack
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            depth = len(self.unfinished)
+            if depth == 0 and tag != "html":
                 self.add_tag("html")
-            elif open_tags == ["html"] and tag not in ["head", "body", "/html"]:
+            elif (
+                depth == 1
+                and self.unfinished[0].tag == "html"
+                and tag not in ["head", "body", "/html"]
+            ):
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")
             elif (
-                open_tags == ["html", "head"] and tag not in ["/head"] + self.HEAD_TAGS
+                depth == 2
+                and self.unfinished[0].tag == "html"
+                and self.unfinished[1].tag == "head"
+                and tag not in ["/head"] + self.HEAD_TAGS
             ):
                 self.add_tag("/head")
             else:
@@ -1,177 +1,260 @@
-from typing import Literal
+import sys
+from bisect import bisect_left
+from itertools import accumulate, groupby, islice
+from typing import Iterable
 
-from display_item import DisplayItem, PendingDisplayItem, Positioning
-from entities import entities
-from font_cache import FontStyle, FontWeight, get_font
-from html_parser import Comment, Element, HtmlNode, Text
+import tracing
+from display_item import (
+    Alignment,
+    DisplayList,
+    LineBreak,
+    PendingDisplayItem,
+    Run,
+    VerticalGap,
+    WordRun,
+)
+from font_cache import (
+    WIDTHS,
+    FontCacheEntry,
+    FontMetrics,
+    TextMetrics,
+    WidthCache,
+)
+from html_parser import Comment, Element, HtmlNode, ParseEvent, Text
+from style import DEFAULT_STYLE, ComputedStyle, computed_style
 
 HSTEP, VSTEP = 13, 18
+# Bump whenever a change here changes the display lists produced, so that
+# saved snapshots of pages are laid out again
+LAYOUT_VERSION = 1
+# Tags that start a new line, and tags that end one (and whether a gap follows)
+BREAK_BEFORE = {"br", "h1", "h2"}
+BREAK_AFTER = {"br": False, "p": True, "h1": True, "h2": False}
+
+
+def run_key(item: tuple[PendingDisplayItem, FontMetrics]):
+    return item[0].font, item[0].positioning
 
 
 class Layout:
-    root: HtmlNode
-    display_list: list[DisplayItem]
+    root: HtmlNode | None
+    display_list: DisplayList
+    runs: list[Run] | None = None
+    # Width of the last render, and how many runs have been laid out at it
+    width: int | None = None
+    placed: int = 0
     line: list[PendingDisplayItem] = []
     cursor_x: int = HSTEP
     cursor_y: int = VSTEP
-    size: int = 16
-    weight: FontWeight = "normal"
-    style: FontStyle = "roman"
-    align: Literal["left", "center", "right"] = "left"
-    positioning: Positioning = "normal"
+    metrics: WidthCache
+    # Computed styles of the open elements, innermost last
+    styles: list[ComputedStyle]
 
-    def __init__(self, root: Text | Element):
+    def __init__(self, root: Text | Element | None, metrics: TextMetrics = WIDTHS):
         self.root = root
+        # Layout relies on the cache for per-font metrics
+        self.metrics = (
+            metrics if isinstance(metrics, WidthCache) else WidthCache(metrics)
+        )
+        self.display_list = DisplayList()
+        self.styles = [DEFAULT_STYLE]
+
+    @classmethod
+    def progressive(cls, metrics: TextMetrics = WIDTHS):
+        # A layout for a document that is still loading. It is built from the
+        # parser's events with `append`, and completed with `finish`.
+        layout = cls(None, metrics)
+        layout.runs = []
+        return layout
 
     def render(self, width: int):
-        self.cursor_x = HSTEP
-        self.cursor_y = VSTEP
+        with tracing.span("layout", width=width):
+            # The words are measured once; later renders (e.g. when the window
+            # is resized) only break the existing runs into lines at the new
+            # width.
+            if self.runs is None:
+                self.runs = []
+                if self.root is not None:
+                    self.recurse(self.root)
+                self.runs.append(LineBreak(self.styles[-1].align))
 
-        self.display_list = []
-        self.line = []
+            self.width = width
+            self.placed = 0
+            self.cursor_x = HSTEP
+            self.cursor_y = VSTEP
+
+            self.display_list = DisplayList()
+            self.line = []
+
+            self.place_runs()
+            return self.display_list
+
+    def append(self, events: Iterable[ParseEvent]):
+        with tracing.span("layout append"):
+            # New lines are added to the end of the display list, leaving the
+            # lines already laid out untouched
+            for kind, node in events:
+                match node:
+                    case Text(text):
+                        for word in text.split():
+                            self.add_word(word)
+                    case Element() if kind == "open":
+                        self.open_tag(node)
+                    case Element():
+                        self.close_tag(node)
+            if self.width is not None:
+                self.place_runs()
 
-        self.recurse(self.root, width)
-        self.flush(width)
+    def finish(self, root: Text | Element):
+        self.root = root
+        self.add_run(LineBreak(self.styles[-1].align))
+        if self.width is not None:
+            self.place_runs()
 
-        return self.display_list
+    def place_runs(self):
+        assert self.runs is not None and self.width is not None
+        width = self.width
+        for run in islice(self.runs, self.placed, None):
+            match run:
+                case WordRun():
+                    self.word(run, width)
+                case LineBreak(alignment):
+                    self.flush(width, alignment)
+                case VerticalGap(height):
+                    self.cursor_y += height
+        self.placed = len(self.runs)
 
-    def recurse(self, tree: HtmlNode, width: int):
+    def recurse(self, tree: HtmlNode):
         match tree:
             case Text(text):
-                for entity, replacement in entities.items():
-                    text = text.replace(entity, replacement)
                 for word in text.split():
-                    self.word(word, width)
+                    self.add_word(word)
             case Element(_):
-                self.open_tag(tree, width)
+                self.open_tag(tree)
                 for child in tree.children:
-                    self.recurse(child, width)
-                self.close_tag(tree, width)
+                    self.recurse(child)
+                self.close_tag(tree)
             case Comment():
                 pass
 
-    def open_tag(self, tag: Element, width: int):
-        tag_name = tag.tag
-        match tag_name.split()[0]:
-            case "i":
-                self.style = "italic"
-            case "b":
-                self.weight = "bold"
-            case "big":
-                self.size += 4
-            case "small":
-                self.size -= 2
-            case "br":
-                self.flush(width)
-            case "h1":
-                self.flush(width)
-                self.size += 8
-                if tag_name == 'h1 class="title"':
-                    self.align = "center"
-            case "h2":
-                self.flush(width)
-                self.size += 4
-            case "sup":
-                self.size //= 2
-                self.positioning = "superscript"
-            case "sub":
-                self.size //= 2
-                self.positioning = "subscript"
-            case _:
-                pass
+    def add_run(self, run: Run):
+        assert self.runs is not None
+        self.runs.append(run)
 
-    def close_tag(self, tag: Element, width: int):
-        tag_name = tag.tag
-        match tag_name.split()[0]:
-            case "i":
-                self.style = "roman"
-            case "b":
-                self.weight = "normal"
-            case "big":
-                self.size -= 4
-            case "small":
-                self.size += 2
-            case "br":
-                self.flush(width)
-            case "p":
-                self.flush(width)
-                self.cursor_y += VSTEP
-            case "h1":
-                self.flush(width)
-                self.size -= 8
-                self.align = "left"
-                self.cursor_y += VSTEP
-            case "h2":
-                self.flush(width)
-                self.size -= 4
-            case "sup":
-                self.size *= 2
-                self.positioning = "normal"
-            case "sub":
-                self.size *= 2
-                self.positioning = "normal"
-            case _:
-                pass
+    def open_tag(self, tag: Element):
+        parent = self.styles[-1]
+        if tag.tag in BREAK_BEFORE:
+            self.add_run(LineBreak(parent.align))
+        self.styles.append(computed_style(tag, parent))
+
+    def close_tag(self, tag: Element):
+        # Closing restores the parent's style exactly
+        style = self.styles.pop()
+        if tag.tag in BREAK_AFTER:
+            self.add_run(LineBreak(style.align))
+            if BREAK_AFTER[tag.tag]:
+                self.add_run(VerticalGap(VSTEP))
+
+    def add_word(self, word: str):
+        style = self.styles[-1]
+        font = FontCacheEntry(style.size, style.weight, style.style)
+        measure = self.metrics.measure
+        font_metrics = self.metrics.font_metrics(font)
 
-    def word(self, word: str, width: int):
-        font = get_font(self.size, self.weight, self.style)
-        w = font.measure(word)
-        if self.cursor_x + w > width - HSTEP:
-            parts = word.split("\N{SOFT HYPHEN}")
-            hyphen_width = font.measure("-")
-
-            i = 0
-            while (
-                self.cursor_x
-                + sum([font.measure(p) for p in parts[: i + 1]])
-                + hyphen_width
-                < width - HSTEP
-            ):
-                i += 1
+        w = measure(font, word)
+        parts = word.split("\N{SOFT HYPHEN}")
+        part_widths: tuple[int, ...] = (w,)
+        if len(parts) > 1:
+            part_widths = tuple(accumulate(measure(font, part) for part in parts))
+
+        self.add_run(
+            WordRun(
+                word,
+                font,
+                w,
+                font_metrics.space_width,
+                font_metrics.hyphen_width,
+                part_widths,
+                style.positioning,
+                style.align,
+            )
+        )
+
+    def word(self, run: WordRun, width: int):
+        if self.cursor_x + run.width > width - HSTEP:
+            # Number of leading parts that fit on this line along with a hyphen
+            i = bisect_left(
+                run.part_widths, width - HSTEP - self.cursor_x - run.hyphen_width
+            )
             if i > 0:
+                parts = run.text.split("\N{SOFT HYPHEN}")
                 partial_word = "".join(parts[:i]) + "-"
                 self.line.append(
                     PendingDisplayItem(
-                        self.cursor_x, partial_word, font, self.positioning
+                        self.cursor_x, partial_word, run.font, run.positioning
                     )
                 )
-            self.flush(width)
+            self.flush(width, run.alignment)
         self.line.append(
-            PendingDisplayItem(self.cursor_x, word, font, self.positioning)
+            PendingDisplayItem(self.cursor_x, run.text, run.font, run.positioning)
         )
-        self.cursor_x += w + font.measure(" ")
+        self.cursor_x += run.width + run.space_width
 
-    def flush(self, width: int):
+    def flush(self, width: int, align: Alignment):
         if not self.line:
             return
+        # Lines are too many for a span object each
+        start = tracing.timestamp() if tracing.enabled else 0.0
 
         offset = 0
         if self.line:
-            if self.align == "center":
+            if align == "center":
                 offset = (width - self.line[-1].x) // 2
-            elif self.align == "right":
+            elif align == "right":
                 offset = width - self.line[-1].x - HSTEP
 
-        metrics = [item.font.metrics() for item in self.line]
-        max_ascent = max([metric["ascent"] for metric in metrics])
+        font_metrics = self.metrics.font_metrics
+        metrics = [font_metrics(item.font) for item in self.line]
+        max_ascent = max([metric.ascent for metric in metrics])
         baseline = self.cursor_y + (max_ascent * 1.25)
 
-        for x, word, font, positioning in self.line:
+        # Neighbouring words in the same font and position are drawn as one
+        # run. Words on a line are always one space apart, so the run's text
+        # lands on the same pixels as the separate words would.
+        items = zip(self.line, metrics)
+        for (font, positioning), group in groupby(items, key=run_key):
+            (x, word, _, _), metric = next(group)
+            words = [word, *(item.text for item, _ in group)]
             match positioning:
                 case "superscript":
-                    y = baseline - font.metrics("ascent") - font.metrics("linespace")
+                    y = baseline - metric.ascent - metric.linespace
                 case "subscript":
-                    y = baseline - font.metrics("ascent") * 0.5
+                    y = baseline - metric.ascent * 0.5
                 case _:
-                    y = baseline - font.metrics("ascent")
-            self.display_list.append(DisplayItem(x + offset, int(y), word, font))
+                    y = baseline - metric.ascent
+            self.display_list.append(x + offset, int(y), " ".join(words), font)
 
-        max_descent = max([metric["descent"] for metric in metrics])
+        max_descent = max([metric.descent for metric in metrics])
         self.cursor_y = int(baseline + (max_descent * 1.25))
         self.cursor_x = HSTEP
+        if tracing.enabled:
+            tracing.add_span(
+                "flush",
+                "browser",
+                start,
+                tracing.timestamp(),
+                {"words": len(self.line)},
+            )
         self.line = []
 
+    def memory_usage(self) -> int:
+        # Approximate bytes held by the layout, not counting the document
+        size = self.display_list.memory_usage()
+        if self.runs is not None:
+            size += sys.getsizeof(self.runs) + sum(map(sys.getsizeof, self.runs))
+        return size
+
     def get_y_max(self):
         if len(self.display_list) == 0:
             return 1
-        return self.display_list[-1].y
+        return self.display_list.ys[-1]
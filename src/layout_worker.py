@@ -0,0 +1,112 @@
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import font_cache
+from display_item import DisplayList, deserialize_runs, serialize_runs
+from font_cache import TableTextMetrics
+from html_parser import HTMLParser
+from layout import Layout
+
+
+def init_worker(metrics: TableTextMetrics):
+    # Worker processes have no Tk, so they measure text with glyph tables
+    font_cache.set_backend(metrics)
+
+
+def layout_page(body: str, width: int) -> tuple[bytes, bytes]:
+    # The measured runs go back with the display list, so laying the page out
+    # at another width later only has to break them into lines again
+    layout = Layout(HTMLParser(body).parse())
+    data = layout.render(width).serialize()
+    assert layout.runs is not None
+    return data, serialize_runs(layout.runs)
+
+
+def reflow_page(runs: bytes, width: int) -> bytes:
+    layout = Layout(None)
+    layout.runs = deserialize_runs(runs)
+    return layout.render(width).serialize()
+
+
+class LayoutPool:
+    # Parses and lays out pages in worker processes, off the Tk thread and
+    # outside its GIL, so several pages can be laid out at once
+    executor: ProcessPoolExecutor
+
+    def __init__(self, metrics: TableTextMetrics, max_workers: int | None = None):
+        self.executor = ProcessPoolExecutor(
+            max_workers, initializer=init_worker, initargs=(metrics,)
+        )
+
+    def submit(self, body: str, width: int) -> "Future[tuple[bytes, bytes]]":
+        return self.executor.submit(layout_page, body, width)
+
+    def reflow(self, runs: bytes, width: int) -> "Future[bytes]":
+        return self.executor.submit(reflow_page, runs, width)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RemoteLayout:
+    # A page laid out by a LayoutPool. Browser only draws its display list;
+    # rendering at a new width sends the page's measured runs back to the pool
+    # and keeps the old display list until `update` picks up the result.
+    pool: LayoutPool
+    # Serialized by `serialize_runs`, as they are only used by the workers
+    runs: bytes
+    width: int
+    display_list: DisplayList
+    pending: "Future[bytes] | None"
+    pending_width: int
+
+    def __init__(
+        self,
+        pool: LayoutPool,
+        runs: bytes,
+        width: int,
+        display_list: DisplayList,
+    ):
+        self.pool = pool
+        self.runs = runs
+        self.width = width
+        self.display_list = display_list
+        self.pending = None
+        self.pending_width = width
+
+    def render(self, width: int):
+        if width != self.pending_width:
+            # Only the latest width matters
+            if self.pending is not None:
+                self.pending.cancel()
+            self.pending = self.pool.reflow(self.runs, width)
+            self.pending_width = width
+        return self.display_list
+
+    def update(self) -> bool:
+        # Whether a new display list arrived
+        if self.pending is None or not self.pending.done():
+            return False
+        pending = self.pending
+        self.pending = None
+        if pending.cancelled():
+            return False
+        try:
+            data = pending.result()
+        except Exception as e:
+            print(e)
+            return False
+        self.display_list = DisplayList.deserialize(data)
+        self.width = self.pending_width
+        return True
+
+    def is_pending(self):
+        return self.pending is not None
+
+    def memory_usage(self) -> int:
+        return sys.getsizeof(self.runs) + self.display_list.memory_usage()
+
+    def get_y_max(self):
+        if len(self.display_list) == 0:
+            return 1
+        return self.display_list.ys[-1]
@@ -0,0 +1,248 @@
+import hashlib
+import queue
+import threading
+import tkinter
+from typing import Callable, NamedTuple
+
+from display_item import DisplayList, serialize_runs
+from history import DocumentCache
+from html_parser import Element, HTMLParser, ParseEvent, Text, tree_events
+from layout_worker import LayoutPool
+from url import URL
+
+POLL_INTERVAL_MS = 16
+
+
+class PageLoad:
+    url: URL
+    # Width to lay the page out at, when it is laid out in a worker process
+    width: int
+    # Hash of the source when the page was last loaded
+    content_hash: str | None
+    # Whether the page is already on screen as it was at `content_hash`, so
+    # there is nothing to do if its source hasn't changed
+    revalidate: bool
+    cancelled: threading.Event
+
+    def __init__(
+        self,
+        url: URL,
+        width: int = 0,
+        content_hash: str | None = None,
+        revalidate: bool = False,
+    ):
+        self.url = url
+        self.width = width
+        self.content_hash = content_hash
+        self.revalidate = revalidate
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class LoadResult(NamedTuple):
+    load: PageLoad
+    events: list[ParseEvent]
+    root: Element | Text | None = None
+    content_hash: str | None = None
+    # The page's serialized runs and display list, from a LayoutPool
+    laid_out: tuple[bytes, bytes] | None = None
+    # The source matched the page on screen
+    unchanged: bool = False
+
+
+class PageLoader:
+    # Fetches and parses pages on a worker thread. Tk isn't thread safe, so
+    # results are collected from the Tk thread by polling with `window.after`.
+    # `on_progress` receives the parse events for each part of the page as it
+    # arrives, and `on_load` the finished tree and a hash of its source.
+    # A page whose source hashes the same as a document in `documents` isn't
+    # parsed again; its cached tree is replayed instead. When revalidating a
+    # page already on screen, an unchanged source only calls `on_unchanged`.
+    #
+    # With a `layout_pool`, pages are instead parsed and laid out in a worker
+    # process, and `on_layout` receives the page's serialized runs, the width
+    # it was laid out at and the serialized display list.
+    window: tkinter.Misc
+    on_progress: Callable[[URL, list[ParseEvent]], None]
+    on_load: Callable[[URL, Element | Text, str], None]
+    on_layout: Callable[[URL, bytes, int, bytes], None]
+    on_unchanged: Callable[[URL], None]
+    documents: DocumentCache
+    layout_pool: LayoutPool | None
+    results: "queue.Queue[LoadResult]"
+    current: PageLoad | None
+    polling: bool
+
+    def __init__(
+        self,
+        window: tkinter.Misc,
+        on_progress: Callable[[URL, list[ParseEvent]], None],
+        on_load: Callable[[URL, Element | Text, str], None],
+        on_layout: Callable[[URL, bytes, int, bytes], None],
+        on_unchanged: Callable[[URL], None],
+        documents: DocumentCache,
+        layout_pool: LayoutPool | None = None,
+    ):
+        self.window = window
+        self.on_progress = on_progress
+        self.on_load = on_load
+        self.on_layout = on_layout
+        self.on_unchanged = on_unchanged
+        self.documents = documents
+        self.layout_pool = layout_pool
+        self.results = queue.Queue()
+        self.current = None
+        self.polling = False
+
+    def load(
+        self,
+        url: URL,
+        width: int = 0,
+        content_hash: str | None = None,
+        revalidate: bool = False,
+    ):
+        # Starting a navigation abandons the previous one
+        self.cancel()
+        load = PageLoad(url, width, content_hash, revalidate)
+        self.current = load
+        run = self.run if self.layout_pool is None else self.run_remote
+        threading.Thread(target=run, args=(load,), daemon=True).start()
+        self.schedule_poll()
+
+    def cancel(self):
+        if self.current is not None:
+            self.current.cancel()
+            self.current = None
+
+    def is_loading(self):
+        return self.current is not None
+
+    def run(self, load: PageLoad):
+        may_match = load.revalidate or load.content_hash in self.documents
+        if may_match and load.url.scheme == "file":
+            # Local files are cheap to read twice, so they are hashed in a
+            # first pass instead of being held back in memory
+            content_hash = self.hash_source(load)
+            if content_hash is None or self.reuse(load, content_hash):
+                return
+            may_match = False
+
+        parser = HTMLParser(record_events=True)
+        digest = hashlib.sha256()
+        # If the page may be unchanged, hold its source back from the parser
+        # until it can be compared with the cached document or the page on screen
+        held: list[str] | None = [] if may_match else None
+        stream = load.url.stream()
+        try:
+            for chunk in stream:
+                if load.cancelled.is_set():
+                    return
+                digest.update(chunk.encode("utf8"))
+                if held is not None:
+                    held.append(chunk)
+                    continue
+                parser.feed(chunk)
+                if events := parser.take_events():
+                    self.results.put(LoadResult(load, events))
+
+            content_hash = digest.hexdigest()
+            if held is not None:
+                if self.reuse(load, content_hash):
+                    return
+                for chunk in held:
+                    parser.feed(chunk)
+            root = parser.close()
+            # Print the tree for debugging
+            parser.print_tree(root)
+        except Exception as e:
+            print(e)
+            content_hash = digest.hexdigest()
+            root = parser.close()
+        finally:
+            # Closing the stream early drops the connection mid-response
+            stream.close()
+        self.results.put(LoadResult(load, parser.take_events(), root, content_hash))
+
+    def hash_source(self, load: PageLoad) -> str | None:
+        # None if the load was cancelled
+        digest = hashlib.sha256()
+        stream = load.url.stream()
+        try:
+            for chunk in stream:
+                if load.cancelled.is_set():
+                    return None
+                digest.update(chunk.encode("utf8"))
+        finally:
+            stream.close()
+        return digest.hexdigest()
+
+    def reuse(self, load: PageLoad, content_hash: str) -> bool:
+        # Whether the source is unchanged, so it doesn't need parsing
+        if load.revalidate and content_hash == load.content_hash:
+            self.results.put(LoadResult(load, [], unchanged=True))
+            return True
+        cached = self.documents.get(content_hash)
+        if cached is None:
+            return False
+        self.results.put(LoadResult(load, tree_events(cached), cached, content_hash))
+        return True
+
+    def run_remote(self, load: PageLoad):
+        assert self.layout_pool is not None
+        chunks: list[str] = []
+        stream = load.url.stream()
+        try:
+            for chunk in stream:
+                if load.cancelled.is_set():
+                    return
+                chunks.append(chunk)
+        finally:
+            stream.close()
+        body = "".join(chunks)
+        try:
+            data, runs = self.layout_pool.submit(body, load.width).result()
+        except Exception as e:
+            print(e)
+            data, runs = DisplayList().serialize(), serialize_runs([])
+        self.results.put(LoadResult(load, [], laid_out=(runs, data)))
+
+    def schedule_poll(self):
+        if not self.polling:
+            self.polling = True
+            self.window.after(POLL_INTERVAL_MS, self.poll)
+
+    def poll(self):
+        self.polling = False
+        # Batch everything that arrived since the last poll into one update
+        events: list[ParseEvent] = []
+        root = None
+        content_hash = ""
+        laid_out = None
+        unchanged = False
+        while not self.results.empty():
+            result = self.results.get_nowait()
+            # Results of cancelled navigations are dropped
+            if result.load is self.current:
+                events.extend(result.events)
+                root = result.root
+                content_hash = result.content_hash or ""
+                laid_out = result.laid_out
+                unchanged = result.unchanged
+
+        load = self.current
+        if load is not None:
+            if events:
+                self.on_progress(load.url, events)
+            if root is not None:
+                self.current = None
+                self.on_load(load.url, root, content_hash)
+            elif laid_out is not None:
+                self.current = None
+                self.on_layout(load.url, laid_out[0], load.width, laid_out[1])
+            elif unchanged:
+                self.current = None
+                self.on_unchanged(load.url)
+            else:
+                self.schedule_poll()
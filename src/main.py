@@ -1,22 +1,51 @@
 import tkinter
 
+import tracing
 from browser import Browser
-from url import URL
+from font_cache import WIDTHS
+from url import URL, cache
+
+TRACE_PATH = "trace.json"
 
 if __name__ == "__main__":
     import sys
 
-    match sys.argv:
+    # Start with the word widths measured in earlier sessions
+    WIDTHS.load()
+
+    # Lay pages out in worker processes instead of on the Tk thread
+    args = sys.argv[:]
+    layout_processes = "--layout-processes" in args
+    if layout_processes:
+        args.remove("--layout-processes")
+
+    # Record a Chrome trace of the session, to load in chrome://tracing
+    trace = "--trace" in args
+    if trace:
+        args.remove("--trace")
+        tracing.start()
+
+    match args:
         case [_, url]:
-            Browser().load(URL(url))
+            browser = Browser(layout_processes=layout_processes)
+            browser.load(URL(url))
         case [_, url, rtl]:
             if rtl == "--rtl":
-                Browser(rtl=True).load(URL(url))
+                browser = Browser(rtl=True, layout_processes=layout_processes)
             else:
-                Browser().load(URL(url))
+                browser = Browser(layout_processes=layout_processes)
+            browser.load(URL(url))
         case _:
-            Browser().load(
+            browser = Browser(layout_processes=layout_processes)
+            browser.load(
                 URL("file:///Users/ryan/dev/browser-engineering/src/test.html")
             )
 
     tkinter.mainloop()
+    if trace:
+        tracing.save(TRACE_PATH)
+    # Reopening the page next time can then skip loading it
+    browser.save_snapshot()
+    browser.close()
+    WIDTHS.save()
+    cache.save_index()
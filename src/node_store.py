@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import struct
+import sys
+from array import array
+from types import MappingProxyType
+from typing import Iterator, Mapping
+
+ELEMENT, TEXT, COMMENT = 0, 1, 2
+NO_NODE = -1
+
+# Shared by every element without attributes
+EMPTY_ATTRS: Mapping[str, str] = MappingProxyType({})
+
+DOCUMENT_MAGIC = b"SLDM"
+DOCUMENT_VERSION = 1
+# Magic, version, number of nodes, texts, tag names and elements with attributes
+HEADER = struct.Struct("<4sHIIII")
+
+
+class NodeStore:
+    # An arena holding a whole document as parallel arrays indexed by node id,
+    # instead of an object (with its own dict, children list and attrs dict)
+    # per node. Children are linked through first_child/next_sibling.
+    kinds: array[int]
+    # Tag id for elements, index into `texts` for text and comments
+    values: array[int]
+    parents: array[int]
+    first_children: array[int]
+    last_children: array[int]
+    next_siblings: array[int]
+    texts: list[str]
+    tag_names: list[str]
+    tag_ids: dict[str, int]
+    # Only elements that have attributes have an entry
+    attrs: dict[int, dict[str, str]]
+
+    def __init__(self):
+        self.kinds = array("b")
+        self.values = array("i")
+        self.parents = array("i")
+        self.first_children = array("i")
+        self.last_children = array("i")
+        self.next_siblings = array("i")
+        self.texts = []
+        self.tag_names = []
+        self.tag_ids = {}
+        self.attrs = {}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def memory_usage(self) -> int:
+        # Approximate bytes held by the document
+        columns = [
+            self.kinds,
+            self.values,
+            self.parents,
+            self.first_children,
+            self.last_children,
+            self.next_siblings,
+        ]
+        size = sum(sys.getsizeof(column) for column in columns)
+        size += sys.getsizeof(self.texts) + sum(map(sys.getsizeof, self.texts))
+        return size + sum(map(sys.getsizeof, self.attrs.values()))
+
+    def add(self, kind: int, value: int, parent: int) -> int:
+        node = len(self.kinds)
+        self.kinds.append(kind)
+        self.values.append(value)
+        self.parents.append(parent)
+        self.first_children.append(NO_NODE)
+        self.last_children.append(NO_NODE)
+        self.next_siblings.append(NO_NODE)
+        return node
+
+    def add_element(self, tag: str, parent: int, attrs: dict[str, str]) -> int:
+        tag_id = self.tag_ids.get(tag)
+        if tag_id is None:
+            tag_id = len(self.tag_names)
+            self.tag_names.append(sys.intern(tag))
+            self.tag_ids[self.tag_names[tag_id]] = tag_id
+        node = self.add(ELEMENT, tag_id, parent)
+        if attrs:
+            self.attrs[node] = attrs
+        return node
+
+    def add_text(self, kind: int, text: str, parent: int) -> int:
+        self.texts.append(text)
+        return self.add(kind, len(self.texts) - 1, parent)
+
+    def append_child(self, parent: int, child: int):
+        last = self.last_children[parent]
+        if last == NO_NODE:
+            self.first_children[parent] = child
+        else:
+            self.next_siblings[last] = child
+        self.last_children[parent] = child
+
+    def tag(self, node: int) -> str:
+        return self.tag_names[self.values[node]]
+
+    def text(self, node: int) -> str:
+        return self.texts[self.values[node]]
+
+    def attributes(self, node: int) -> Mapping[str, str]:
+        return self.attrs.get(node, EMPTY_ATTRS)
+
+    def children(self, node: int) -> Iterator[int]:
+        child = self.first_children[node]
+        while child != NO_NODE:
+            yield child
+            child = self.next_siblings[child]
+
+    def serialize(self) -> bytes:
+        # Texts, tag names and attribute keys and values share one string table
+        strings = [*self.texts, *self.tag_names]
+        for attrs in self.attrs.values():
+            for key, value in attrs.items():
+                strings += (key, value)
+        encoded = [string.encode("utf8") for string in strings]
+        columns = [
+            self.values,
+            self.parents,
+            self.first_children,
+            self.last_children,
+            self.next_siblings,
+            array("i", self.attrs),
+            array("i", [len(attrs) for attrs in self.attrs.values()]),
+            array("i", [len(string) for string in encoded]),
+        ]
+        if sys.byteorder == "big":
+            columns = [array("i", column) for column in columns]
+            for column in columns:
+                column.byteswap()
+
+        header = HEADER.pack(
+            DOCUMENT_MAGIC,
+            DOCUMENT_VERSION,
+            len(self),
+            len(self.texts),
+            len(self.tag_names),
+            len(self.attrs),
+        )
+        return b"".join(
+            [
+                header,
+                self.kinds.tobytes(),
+                *(column.tobytes() for column in columns),
+                *encoded,
+            ]
+        )
+
+    @classmethod
+    def deserialize(cls, data: bytes | memoryview):
+        view = memoryview(data)
+        magic, version, nodes, texts, tags, elements = HEADER.unpack_from(view)
+        if magic != DOCUMENT_MAGIC or version != DOCUMENT_VERSION:
+            raise ValueError("Not a document, or an unsupported version")
+        offset = HEADER.size
+
+        def column(typecode: str, length: int):
+            nonlocal offset
+            values = array(typecode)
+            values.frombytes(view[offset : offset + length * values.itemsize])
+            offset += length * values.itemsize
+            if sys.byteorder == "big":
+                values.byteswap()
+            return values
+
+        store = cls()
+        store.kinds = column("b", nodes)
+        store.values = column("i", nodes)
+        store.parents = column("i", nodes)
+        store.first_children = column("i", nodes)
+        store.last_children = column("i", nodes)
+        store.next_siblings = column("i", nodes)
+        with_attrs = column("i", elements)
+        counts = column("i", elements)
+        strings: list[str] = []
+        for length in column("i", texts + tags + 2 * sum(counts)):
+            strings.append(str(view[offset : offset + length], "utf8"))
+            offset += length
+
+        store.texts = strings[:texts]
+        store.tag_names = [sys.intern(tag) for tag in strings[texts : texts + tags]]
+        store.tag_ids = {tag: i for i, tag in enumerate(store.tag_names)}
+        pairs = iter(strings[texts + tags :])
+        for node, count in zip(with_attrs, counts):
+            store.attrs[node] = {next(pairs): next(pairs) for _ in range(count)}
+        return store
@@ -0,0 +1,115 @@
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, TypeAlias
+
+# (family, sockaddr), as taken by socket.socket and socket.connect
+Address: TypeAlias = tuple[socket.AddressFamily, tuple[Any, ...]]
+Lookup: TypeAlias = Callable[[str, int], list[Address]]
+
+
+def system_lookup(host: str, port: int) -> list[Address]:
+    # Both IPv6 and IPv4 addresses, in the system's preferred order
+    addresses: list[Address] = []
+    for family, _, _, _, sockaddr in socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM
+    ):
+        if family in (socket.AF_INET, socket.AF_INET6):
+            address: Address = (family, sockaddr)
+            if address not in addresses:
+                addresses.append(address)
+    return addresses
+
+
+class PendingLookup:
+    done: threading.Event
+    addresses: list[Address]
+    error: Exception | None
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.addresses = []
+        self.error = None
+
+
+class Resolver:
+    # Caches lookups for `ttl` seconds, keeping at most `max_entries` hosts.
+    # getaddrinfo doesn't expose the records' own TTLs, so one is assumed.
+    # Threads resolving the same host at once share a single lookup.
+    lookup: Lookup
+    ttl: float
+    max_entries: int
+    # Least recently used first, with the time each entry expires
+    entries: OrderedDict[tuple[str, int], tuple[float, list[Address]]]
+    pending: dict[tuple[str, int], PendingLookup]
+    hits: int
+    misses: int
+
+    def __init__(
+        self, lookup: Lookup = system_lookup, ttl: float = 60.0, max_entries: int = 256
+    ):
+        self.lookup = lookup
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def resolve(self, host: str, port: int) -> list[Address]:
+        key = (host, port)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry[1]
+
+            self.misses += 1
+            pending = self.pending.get(key)
+            owner = pending is None
+            if pending is None:
+                pending = self.pending[key] = PendingLookup()
+
+        if not owner:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.addresses
+
+        try:
+            pending.addresses = self.lookup(host, port)
+            if not pending.addresses:
+                raise OSError(f"No addresses found for {host}")
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+                if pending.error is None:
+                    self.insert(key, pending.addresses)
+            pending.done.set()
+        return pending.addresses
+
+    def insert(self, key: tuple[str, int], addresses: list[Address]):
+        # Must be called with the lock held
+        self.entries[key] = (time.monotonic() + self.ttl, addresses)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def forget(self, host: str, port: int):
+        # E.g. when none of the addresses could be reached
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,115 @@
+import codecs
+import mmap
+import os
+import zlib
+from typing import BinaryIO, Iterable, Iterator
+
+import tracing
+from connection_pool import ConnectionClosed
+
+BUFFER_SIZE = 64 * 1024
+
+
+def read_body(response: BinaryIO, headers: dict[str, str]) -> Iterator[memoryview]:
+    # Every chunk is a view into one preallocated buffer, so it is only valid
+    # until the next one is requested
+    view = memoryview(bytearray(BUFFER_SIZE))
+
+    if headers.get("transfer-encoding", "") == "chunked":
+        while True:
+            size_line = response.readline()
+            if not size_line:
+                raise ConnectionClosed("Connection closed in chunked body")
+            chunk_length = int(size_line.split(b";", 1)[0], 16)
+            if chunk_length == 0:
+                break
+            yield from read_exactly(response, chunk_length, view)
+            response.read(2)
+        # Skip any trailers up to the final blank line
+        while response.readline() not in (b"\r\n", b"\n", b""):
+            pass
+    elif "content-length" in headers:
+        yield from read_exactly(response, int(headers["content-length"]), view)
+    else:
+        # No framing, so the body runs until the server closes the connection
+        while n := response.readinto(view):
+            yield view[:n]
+
+
+def read_exactly(
+    response: BinaryIO, length: int, view: memoryview
+) -> Iterator[memoryview]:
+    while length > 0:
+        n = response.readinto(view[: min(length, len(view))])
+        if n == 0:
+            raise ConnectionClosed("Connection closed before the end of the body")
+        yield view[:n]
+        length -= n
+
+
+def read_file(path: str, mmap_threshold: int = 1024 * 1024) -> Iterator[bytes]:
+    # Opens the file straight away, not when the body is first read
+    return read_opened(open(path, "rb"), mmap_threshold)
+
+
+def read_opened(f: BinaryIO, mmap_threshold: int) -> Iterator[bytes]:
+    with f:
+        if os.fstat(f.fileno()).st_size < mmap_threshold:
+            yield f.read()
+            return
+        # Map large files instead of reading them into memory up front, so
+        # only one chunk at a time is ever copied out
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for i in range(0, len(data), BUFFER_SIZE):
+                yield data[i : i + BUFFER_SIZE]
+
+
+def decompress(
+    chunks: Iterable[memoryview | bytes], content_encoding: str
+) -> Iterator[bytes | memoryview]:
+    match content_encoding:
+        case "gzip" | "x-gzip":
+            # 16 + MAX_WBITS expects a gzip header and trailer
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        case "deflate":
+            decompressor = zlib.decompressobj()
+        case _:
+            yield from chunks
+            return
+
+    first = True
+    for chunk in chunks:
+        if first and content_encoding == "deflate":
+            first = False
+            try:
+                decompressor.copy().decompress(chunk[:2])
+            except zlib.error:
+                # Some servers send raw deflate data without the zlib header
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        # Cap each output so a highly compressed body can't balloon in memory
+        data = decompressor.decompress(chunk, BUFFER_SIZE)
+        while True:
+            if data:
+                yield data
+            if not decompressor.unconsumed_tail and len(data) < BUFFER_SIZE:
+                break
+            data = decompressor.decompress(decompressor.unconsumed_tail, BUFFER_SIZE)
+
+    if tail := decompressor.flush():
+        yield tail
+
+
+def decode_body(
+    chunks: Iterable[memoryview | bytes], content_encoding: str
+) -> Iterator[str]:
+    # Multi-byte characters may be split across chunks
+    decoder = codecs.getincrementaldecoder("utf8")()
+    decompressed = decompress(chunks, content_encoding)
+    if content_encoding:
+        decompressed = tracing.traced("decompress", decompressed)
+    for data in decompressed:
+        if text := decoder.decode(data):
+            yield text
+    if text := decoder.decode(b"", final=True):
+        yield text
@@ -0,0 +1,185 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+
+from display_item import DisplayList
+from html_parser import Comment, Element, HtmlNode, Text, node_view
+from layout import LAYOUT_VERSION, Layout
+from node_store import NodeStore
+from url import URL
+
+SNAPSHOT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "slama", "snapshots")
+SNAPSHOT_MAGIC = b"SLSN"
+SNAPSHOT_VERSION = 1
+# Magic, version, layout version, content width, scroll, root node, content
+# hash and the lengths of the serialized display list and document
+HEADER = struct.Struct("<4sHHiii64sII")
+SCROLL = struct.Struct("<i")
+SCROLL_OFFSET = struct.calcsize("<4sHHi")
+
+
+def snapshot_path(url: URL, directory: str = SNAPSHOT_DIR) -> str:
+    match url.scheme:
+        case "http" | "https":
+            key = url.get_url_string()
+        case "file":
+            key = "file://" + url.path
+        case _:
+            key = f"{url.scheme}:{url.path}"
+    if url.view_source:
+        key = "view-source:" + key
+    name = hashlib.sha256(key.encode("utf8")).hexdigest()
+    return os.path.join(directory, name + ".snapshot")
+
+
+def save_snapshot(
+    url: URL,
+    root: HtmlNode,
+    display_list: DisplayList,
+    width: int,
+    scroll: int,
+    content_hash: str,
+    directory: str = SNAPSHOT_DIR,
+):
+    os.makedirs(directory, exist_ok=True)
+    laid_out = display_list.serialize()
+    document = root.store.serialize()
+    header = HEADER.pack(
+        SNAPSHOT_MAGIC,
+        SNAPSHOT_VERSION,
+        LAYOUT_VERSION,
+        width,
+        scroll,
+        root.index,
+        content_hash.encode("ascii"),
+        len(laid_out),
+        len(document),
+    )
+    # Write to a temporary file first so a crash can't leave a torn snapshot,
+    # with a name of its own in case another browser is saving the same page
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(laid_out)
+            f.write(document)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, snapshot_path(url, directory))
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def save_scroll(url: URL, scroll: int, directory: str = SNAPSHOT_DIR):
+    # For a page shown from its snapshot, the rest of which is still current
+    try:
+        with open(snapshot_path(url, directory), "r+b") as f:
+            f.seek(SCROLL_OFFSET)
+            f.write(SCROLL.pack(scroll))
+    except FileNotFoundError:
+        pass
+
+
+def remove_snapshot(url: URL, directory: str = SNAPSHOT_DIR):
+    try:
+        os.remove(snapshot_path(url, directory))
+    except FileNotFoundError:
+        pass
+
+
+class SnapshotLayout:
+    # A page as it was last shown, saved by `save_snapshot`, so it can be shown
+    # again without fetching, parsing or laying it out. The display list is
+    # read straight away; the document stays in the mapped file until the page
+    # has to be laid out again, e.g. at a new width.
+    content_hash: str
+    width: int
+    scroll: int
+    display_list: DisplayList
+    root_index: int
+    # The mapped snapshot and where the document is in it, until it is read
+    data: mmap.mmap | None
+    document_start: int
+    document_end: int
+    document: Element | Text | None
+    layout: Layout | None
+
+    def __init__(self, data: mmap.mmap):
+        (
+            magic,
+            version,
+            layout_version,
+            self.width,
+            self.scroll,
+            self.root_index,
+            content_hash,
+            list_size,
+            document_size,
+        ) = HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("Not a snapshot, or an unsupported version")
+        if layout_version != LAYOUT_VERSION:
+            raise ValueError("Snapshot was laid out by another layout version")
+        self.content_hash = content_hash.decode("ascii")
+        self.document_start = HEADER.size + list_size
+        self.document_end = self.document_start + document_size
+        if self.document_end > len(data):
+            raise ValueError("Snapshot is truncated")
+        self.display_list = DisplayList.deserialize(
+            memoryview(data)[HEADER.size : self.document_start]
+        )
+        self.data = data
+        self.document = None
+        self.layout = None
+
+    @classmethod
+    def open(cls, url: URL, directory: str = SNAPSHOT_DIR) -> "SnapshotLayout | None":
+        path = snapshot_path(url, directory)
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            return cls(data)
+        except (struct.error, ValueError, KeyError, IndexError) as e:
+            # Left by an older version of the browser, or damaged
+            print(e)
+            remove_snapshot(url, directory)
+            return None
+
+    def load_document(self) -> Element | Text:
+        if self.document is None:
+            data = self.data
+            assert data is not None
+            store = NodeStore.deserialize(
+                memoryview(data)[self.document_start : self.document_end]
+            )
+            root = node_view(store, self.root_index)
+            assert not isinstance(root, Comment)
+            self.document = root
+            self.data = None
+            data.close()
+        return self.document
+
+    def render(self, width: int):
+        if self.layout is None:
+            if width == self.width:
+                return self.display_list
+            self.layout = Layout(self.load_document())
+        self.display_list = self.layout.render(width)
+        self.width = width
+        return self.display_list
+
+    def memory_usage(self) -> int:
+        if self.layout is not None:
+            return self.layout.memory_usage()
+        return self.display_list.memory_usage()
+
+    def get_y_max(self):
+        if len(self.display_list) == 0:
+            return 1
+        return self.display_list.ys[-1]
@@ -0,0 +1,59 @@
+from typing import Callable, NamedTuple, TypeAlias
+from weakref import WeakKeyDictionary
+
+from display_item import Alignment, Positioning
+from font_cache import FontStyle, FontWeight
+from html_parser import Element
+from node_store import NodeStore
+
+
+class ComputedStyle(NamedTuple):
+    size: int
+    weight: FontWeight
+    style: FontStyle
+    align: Alignment
+    positioning: Positioning
+
+
+DEFAULT_STYLE = ComputedStyle(16, "normal", "roman", "left", "normal")
+
+# Computes an element's style from its parent's
+StyleHandler: TypeAlias = Callable[[ComputedStyle, Element], ComputedStyle]
+
+
+def h1_style(parent: ComputedStyle, element: Element):
+    style = parent._replace(size=parent.size + 8)
+    if element.attrs.get("class") == "title":
+        style = style._replace(align="center")
+    return style
+
+
+STYLE_HANDLERS: dict[str, StyleHandler] = {
+    "i": lambda parent, _: parent._replace(style="italic"),
+    "b": lambda parent, _: parent._replace(weight="bold"),
+    "big": lambda parent, _: parent._replace(size=parent.size + 4),
+    "small": lambda parent, _: parent._replace(size=parent.size - 2),
+    "h1": h1_style,
+    "h2": lambda parent, _: parent._replace(size=parent.size + 4),
+    "sup": lambda parent, _: parent._replace(
+        size=parent.size // 2, positioning="superscript"
+    ),
+    "sub": lambda parent, _: parent._replace(
+        size=parent.size // 2, positioning="subscript"
+    ),
+}
+
+# Styles only depend on the tree, so they are kept per document, by node index
+STYLES: WeakKeyDictionary[NodeStore, dict[int, ComputedStyle]] = WeakKeyDictionary()
+
+
+def computed_style(element: Element, parent: ComputedStyle) -> ComputedStyle:
+    styles = STYLES.get(element.store)
+    if styles is None:
+        styles = STYLES[element.store] = {}
+    style = styles.get(element.index)
+    if style is None:
+        handler = STYLE_HANDLERS.get(element.tag)
+        style = handler(parent, element) if handler is not None else parent
+        styles[element.index] = style
+    return style
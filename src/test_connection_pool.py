@@ -0,0 +1,151 @@
+import errno
+import socket
+import threading
+import time
+import unittest
+
+from connection_pool import Connection, ConnectionPool, connect_fastest, interleave
+from resolver import Address, Resolver
+
+
+def listener() -> socket.socket:
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    s.listen(8)
+    return s
+
+
+def refused_address() -> Address:
+    # A port that was just free, so nothing is listening on it
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    sockaddr = s.getsockname()
+    s.close()
+    return (socket.AF_INET, sockaddr)
+
+
+class Blackhole:
+    # A listener with a full accept queue, which drops further connection
+    # attempts instead of refusing them, like an unreachable address
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(0)
+        self.address: Address = (socket.AF_INET, self.listener.getsockname())
+        self.filler = socket.create_connection(self.listener.getsockname())
+
+    def close(self):
+        self.filler.close()
+        self.listener.close()
+
+
+class ConnectFastestTest(unittest.TestCase):
+    def setUp(self):
+        self.server = listener()
+        self.good: Address = (socket.AF_INET, self.server.getsockname())
+        self.blackhole = Blackhole()
+
+    def tearDown(self):
+        self.server.close()
+        self.blackhole.close()
+
+    def test_falls_back_after_refused(self):
+        start = time.monotonic()
+        s = connect_fastest([refused_address(), self.good], attempt_delay=5)
+        with s:
+            self.assertEqual(s.getpeername(), self.good[1])
+        # A refused attempt doesn't wait out the attempt delay
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_races_past_unreachable(self):
+        start = time.monotonic()
+        s = connect_fastest([self.blackhole.address, self.good], attempt_delay=0.1)
+        with s:
+            self.assertEqual(s.getpeername(), self.good[1])
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_all_refused(self):
+        with self.assertRaises(OSError) as raised:
+            connect_fastest([refused_address(), refused_address()])
+        self.assertEqual(raised.exception.errno, errno.ECONNREFUSED)
+
+    def test_timeout(self):
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            connect_fastest([self.blackhole.address], timeout=0.2)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_no_addresses(self):
+        with self.assertRaisesRegex(OSError, "No addresses"):
+            connect_fastest([])
+
+    def test_interleave(self):
+        v6 = [(socket.AF_INET6, ("::1", port, 0, 0)) for port in (1, 2, 3)]
+        v4 = [(socket.AF_INET, ("127.0.0.1", port)) for port in (4, 5)]
+        ordered = interleave([v6[0], v6[1], v4[0], v6[2], v4[1]])
+        self.assertEqual(ordered, [v6[0], v4[0], v6[1], v4[1], v6[2]])
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def test_connects_with_stub_resolver(self):
+        server = listener()
+        lookups: list[str] = []
+        good: Address = (socket.AF_INET, server.getsockname())
+
+        def lookup(host: str, port: int) -> list[Address]:
+            lookups.append(host)
+            return [refused_address(), good]
+
+        pool = ConnectionPool(resolver=Resolver(lookup))
+        key = ("http", "example.test", good[1][1])
+        first = pool.acquire(key)
+        second = pool.acquire(key, reuse=False)
+        self.assertEqual(first.sock.getpeername(), good[1])
+        self.assertEqual(lookups, ["example.test"])
+        first.close()
+        second.close()
+        server.close()
+
+    def test_waits_for_a_released_connection(self):
+        server = listener()
+        good: Address = (socket.AF_INET, server.getsockname())
+        pool = ConnectionPool(
+            max_per_host=1, resolver=Resolver(lambda host, port: [good])
+        )
+        key = ("http", "example.test", good[1][1])
+        first = pool.acquire(key)
+        acquired: list[Connection] = []
+        waiter = threading.Thread(
+            target=lambda: acquired.append(pool.acquire(key)), daemon=True
+        )
+        waiter.start()
+        # The second acquire has to wait while the only connection is in use
+        time.sleep(0.1)
+        self.assertEqual(acquired, [])
+        pool.release(first)
+        waiter.join(5)
+
+        self.assertEqual(acquired, [first])
+        self.assertEqual(
+            pool.stats(), {"hits": 1, "misses": 1, "stale": 0, "idle": 0, "open": 1}
+        )
+        pool.close()
+        first.close()
+        server.close()
+
+    def test_forgets_unreachable_host(self):
+        lookups: list[str] = []
+
+        def lookup(host: str, port: int) -> list[Address]:
+            lookups.append(host)
+            return [refused_address()]
+
+        pool = ConnectionPool(resolver=Resolver(lookup))
+        for _ in range(2):
+            with self.assertRaises(OSError):
+                pool.acquire(("http", "example.test", 80))
+        self.assertEqual(lookups, ["example.test", "example.test"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+from resolver import Address, Resolver
+
+
+def address(port: int) -> Address:
+    return (socket.AF_INET, ("127.0.0.1", port))
+
+
+class StubLookup:
+    # Answers every lookup with the host's port, counting the calls
+    calls: list[tuple[str, int]]
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, host: str, port: int) -> list[Address]:
+        self.calls.append((host, port))
+        return [address(port)]
+
+
+class ResolverTest(unittest.TestCase):
+    def test_caches_until_ttl(self):
+        lookup = StubLookup()
+        resolver = Resolver(lookup, ttl=60)
+        with mock.patch("resolver.time.monotonic", return_value=100.0):
+            self.assertEqual(resolver.resolve("a.test", 80), [address(80)])
+            self.assertEqual(resolver.resolve("a.test", 80), [address(80)])
+        self.assertEqual(len(lookup.calls), 1)
+
+        with mock.patch("resolver.time.monotonic", return_value=161.0):
+            resolver.resolve("a.test", 80)
+        self.assertEqual(len(lookup.calls), 2)
+        self.assertEqual(resolver.stats(), {"entries": 1, "hits": 1, "misses": 2})
+
+    def test_evicts_least_recently_used(self):
+        lookup = StubLookup()
+        resolver = Resolver(lookup, max_entries=2)
+        resolver.resolve("a.test", 80)
+        resolver.resolve("b.test", 80)
+        resolver.resolve("a.test", 80)
+        resolver.resolve("c.test", 80)
+        self.assertEqual(list(resolver.entries), [("a.test", 80), ("c.test", 80)])
+
+        resolver.resolve("b.test", 80)
+        self.assertEqual(lookup.calls.count(("b.test", 80)), 2)
+
+    def test_forget(self):
+        lookup = StubLookup()
+        resolver = Resolver(lookup)
+        resolver.resolve("a.test", 80)
+        resolver.forget("a.test", 80)
+        resolver.resolve("a.test", 80)
+        self.assertEqual(len(lookup.calls), 2)
+
+    def test_shares_concurrent_lookups(self):
+        started = threading.Event()
+        release = threading.Event()
+        lookup = StubLookup()
+
+        def slow_lookup(host: str, port: int) -> list[Address]:
+            started.set()
+            release.wait(5)
+            return lookup(host, port)
+
+        resolver = Resolver(slow_lookup)
+        results: list[list[Address]] = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(resolver.resolve("a.test", 80))
+            )
+            for _ in range(4)
+        ]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # Let the others reach the pending lookup before it finishes
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, [[address(80)]] * 4)
+        self.assertEqual(len(lookup.calls), 1)
+
+    def test_shares_errors_without_caching_them(self):
+        calls: list[str] = []
+
+        def failing_lookup(host: str, port: int) -> list[Address]:
+            calls.append(host)
+            return []
+
+        resolver = Resolver(failing_lookup)
+        with self.assertRaises(OSError):
+            resolver.resolve("a.test", 80)
+        with self.assertRaises(OSError):
+            resolver.resolve("a.test", 80)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(resolver.stats()["entries"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
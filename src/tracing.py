@@ -0,0 +1,125 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Any, ContextManager, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# Tracing is off unless `start` is called, and until then every span and
+# counter costs a single check of this flag. Events are in Chrome's trace
+# event format, see chrome://tracing or https://ui.perfetto.dev.
+enabled = False
+events: list[dict[str, Any]] = []
+counters: dict[str, int] = {}
+lock = threading.Lock()
+start_time = 0.0
+
+NO_SPAN: ContextManager[None] = contextlib.nullcontext()
+
+
+def start():
+    global enabled, start_time
+    events.clear()
+    counters.clear()
+    start_time = time.perf_counter()
+    enabled = True
+
+
+def stop():
+    global enabled
+    enabled = False
+
+
+def timestamp() -> float:
+    # Chrome traces are in microseconds
+    return (time.perf_counter() - start_time) * 1_000_000
+
+
+class Span:
+    __slots__ = ("name", "category", "args", "start")
+
+    def __init__(self, name: str, category: str, args: dict[str, Any]):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = timestamp()
+
+    def __exit__(self, *exc: object):
+        add_span(self.name, self.category, self.start, timestamp(), self.args)
+
+
+def add_span(name: str, category: str, start: float, end: float, args: dict[str, Any]):
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": start,
+        "dur": end - start,
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+    }
+    if args:
+        event["args"] = args
+    events.append(event)
+
+
+def span(name: str, category: str = "browser", **args: Any) -> ContextManager[None]:
+    if not enabled:
+        return NO_SPAN
+    return Span(name, category, args)
+
+
+def traced(name: str, chunks: Iterable[T], category: str = "network") -> Iterator[T]:
+    # Times each step of an iterator, e.g. each read of a response body
+    if not enabled:
+        yield from chunks
+        return
+    iterator = iter(chunks)
+    while True:
+        start = timestamp()
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        add_span(name, category, start, timestamp(), {})
+        yield chunk
+
+
+def count(name: str, n: int = 1):
+    if not enabled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+def sample(name: str, values: dict[str, int]):
+    # Records the current value of a group of counters in the trace
+    if not enabled:
+        return
+    with lock:
+        args = dict(values)
+    events.append(
+        {
+            "name": name,
+            "ph": "C",
+            "ts": timestamp(),
+            "pid": os.getpid(),
+            "args": args,
+        }
+    )
+
+
+def save(path: str):
+    sample("counters", counters)
+    data = {
+        "traceEvents": events,
+        "displayTimeUnit": "ms",
+        "otherData": {"counters": dict(counters)},
+    }
+    with open(path, "w", encoding="utf8") as f:
+        json.dump(data, f)
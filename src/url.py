@@ -1,22 +1,46 @@
-import gzip
-import socket
-import ssl
+import threading
 import time
-from dataclasses import dataclass
+from typing import Iterable, Iterator
 
-from entities import entities
+import tracing
+from connection_pool import Connection, ConnectionClosed, ConnectionPool
+from disk_cache import CacheEntry, CacheWriter, DiskCache
+from entities import encode
+from response_body import decode_body, read_body, read_file
 
-# (host, port) -> socket
-sockets: dict[tuple[str, int], socket.socket] = {}
+pool = ConnectionPool()
+cache = DiskCache()
 
+# URLs with a background revalidation in flight
+revalidating: set[str] = set()
+revalidating_lock = threading.Lock()
 
-@dataclass(frozen=True)
-class CacheEntry:
-    content: str
-    expires: float
+# Headers that describe the stored body, so a 304 must not replace them
+BODY_HEADERS = ["content-encoding", "content-length", "transfer-encoding"]
 
 
-cache: dict[str, CacheEntry] = {}
+def parse_cache_control(value: str) -> dict[str, str]:
+    directives: dict[str, str] = {}
+    for directive in value.split(","):
+        name, _, argument = directive.strip().partition("=")
+        if name:
+            directives[name.casefold()] = argument.strip('"')
+    return directives
+
+
+def seconds_directive(directives: dict[str, str], name: str) -> int:
+    try:
+        return max(0, int(directives.get(name, "0")))
+    except ValueError:
+        return 0
+
+
+def expiry(headers: dict[str, str]) -> float:
+    directives = parse_cache_control(headers.get("cache-control", ""))
+    if "no-cache" in directives:
+        # Stored, but must be revalidated before every use
+        return time.time()
+    return time.time() + seconds_directive(directives, "max-age")
 
 
 class URL:
@@ -28,7 +52,7 @@ class URL:
     headers: dict[str, str] = {
         "User-Agent": "Slama/0.1",
         "Connection": "keep-alive",
-        "Accept-Encoding": "gzip",
+        "Accept-Encoding": "gzip, deflate",
     }
     redirects: list[str]
 
@@ -68,11 +92,15 @@ class URL:
         return f"{self.scheme}://{self.host}:{self.port}{self.path}"
 
     def request(self) -> str:
+        return "".join(self.stream())
+
+    def stream(self) -> Iterator[str]:
+        # Yields the body as decoded text chunks as soon as they arrive
         try:
-            return self.make_request()
+            yield from self.make_stream()
         except Exception as e:
             print(e)
-            return self.about("blank")
+            yield self.about("blank")
 
     def about(self, path: str) -> str:
         match path:
@@ -81,69 +109,134 @@ class URL:
             case _:
                 raise Exception(f"Unknown about: URL: {path}")
 
-    def make_request(self) -> str:
+    def make_stream(self) -> Iterator[str]:
         if self.scheme == "file":
-            with open(self.path, "rb") as f:
-                return f.read().decode("utf8")
+            # Decoded a chunk at a time, so the parser can start right away
+            yield from decode_body(read_file(self.path), "")
+            return
 
         if self.scheme == "data":
-            return self.path
+            yield self.path
+            return
 
         if self.scheme == "about":
             match self.path:
                 case "blank":
-                    return self.about("blank")
+                    yield self.about("blank")
+                    return
                 case _:
                     raise Exception(f"Unknown about: URL: {self.path}")
 
-        if self.get_url_string() in cache:
-            entry = cache[self.get_url_string()]
-            if entry.expires > time.time():
-                return entry.content
-            else:
-                del cache[self.get_url_string()]
-
-        s = self.get_socket()
-
-        if self.scheme == "https":
-            ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname=self.host)
-
-        request = self.build_request()
-        s.send(request.encode("utf8"))
-
-        response = s.makefile("rb")
-        statusline = response.readline().decode("utf8")
-        _version, status, _explanation = statusline.split(" ", 2)
+        # Spans the whole request, including the time the caller spends on
+        # each chunk of the body
+        with tracing.span("request", "network", url=self.get_url_string()):
+            yield from self.make_http_stream()
+
+    def make_http_stream(self) -> Iterator[str]:
+        entry = cache.get(self.get_url_string())
+        if entry is not None:
+            now = time.time()
+            if entry.expires > now:
+                tracing.count("http cache hit")
+                yield from self.read_cached(entry)
+                return
+
+            # Serve a copy that is only slightly stale straight away, and fetch
+            # a fresh one for next time
+            directives = parse_cache_control(entry.headers.get("cache-control", ""))
+            if now < entry.expires + seconds_directive(
+                directives, "stale-while-revalidate"
+            ):
+                tracing.count("http cache stale hit")
+                self.revalidate_in_background(entry)
+                yield from self.read_cached(entry)
+                return
+
+        tracing.count("http cache miss")
+        yield from self.fetch(entry)
+
+    def read_cached(self, entry: CacheEntry) -> Iterator[str]:
+        body = cache.read(entry)
+        if body is None:
+            # A background revalidation or eviction got there first
+            yield from self.fetch(None)
+            return
+        content_encoding = entry.headers.get("content-encoding", "")
+        yield from self.decode(body, content_encoding)
+
+    def revalidate_in_background(self, entry: CacheEntry):
+        with revalidating_lock:
+            if entry.url in revalidating:
+                return
+            revalidating.add(entry.url)
+
+        def revalidate():
+            try:
+                for _ in self.fetch(entry):
+                    pass
+            except Exception as e:
+                print(e)
+            finally:
+                with revalidating_lock:
+                    revalidating.discard(entry.url)
+
+        threading.Thread(target=revalidate, daemon=True).start()
+
+    def fetch(self, entry: CacheEntry | None) -> Iterator[str]:
+        # Ask the server to skip the body if our cached copy is still current
+        conditional_headers: dict[str, str] = {}
+        if entry is not None:
+            if "etag" in entry.headers:
+                conditional_headers["If-None-Match"] = entry.headers["etag"]
+            if "last-modified" in entry.headers:
+                conditional_headers["If-Modified-Since"] = entry.headers[
+                    "last-modified"
+                ]
+
+        connection, status, response_headers = self.send_request(conditional_headers)
+        reusable = response_headers.get("connection", "").casefold() != "close"
+        content_encoding = response_headers.get("content-encoding", "")
 
-        response_headers: dict[str, str] = {}
-        while True:
-            line = response.readline().decode("utf8")
-            if line == "\r\n":
-                break
-            header, value = line.split(":", 1)
-            response_headers[header.casefold()] = value.strip()
+        if status == "304" and entry is not None:
+            # Not Modified responses never have a body
+            tracing.count("http cache revalidated")
+            pool.release(connection, reusable)
+            headers = {
+                header: value
+                for header, value in entry.headers.items()
+                if header in BODY_HEADERS
+            }
+            headers.update(
+                (header, value)
+                for header, value in response_headers.items()
+                if header not in BODY_HEADERS
+            )
+            entry = CacheEntry(
+                entry.url, entry.filename, entry.size, headers, expiry(headers)
+            )
+            cache.update(entry)
+            yield from self.read_cached(entry)
+            return
 
-        content_encoding = response_headers.get("content-encoding", "")
-        transfer_encoding = response_headers.get("transfer-encoding", "")
-        if transfer_encoding == "chunked":
-            body_bytes = b""
-            while True:
-                chunk_length = int(response.readline().decode("utf8"), 16)
-                body_bytes += response.read(chunk_length)
-                response.read(2)
-                if chunk_length == 0:
-                    break
-        else:
-            content_length = int(response_headers["content-length"])
-            body_bytes = response.read(content_length)
+        if (
+            "transfer-encoding" not in response_headers
+            and "content-length" not in response_headers
+        ):
+            # The body ends when the server closes the connection
+            reusable = False
 
-        if content_encoding == "gzip":
-            content = gzip.decompress(body_bytes).decode("utf8")
-        else:
-            content = body_bytes.decode("utf8")
+        body = tracing.traced("body", read_body(connection.file, response_headers))
 
         if status == "301" or status == "302":
+            # Finish reading the body so the connection can be reused
+            try:
+                for _ in body:
+                    pass
+            except BaseException:
+                pool.discard(connection)
+                raise
+            pool.release(connection, reusable)
+
             location = response_headers["location"]
             if location in self.redirects:
                 raise Exception("Redirect loop")
@@ -153,44 +246,105 @@ class URL:
             if location.startswith("/"):
                 location = f"{self.scheme}://{self.host}:{self.port}{location}"
 
-            return URL(location, self.redirects + [location]).request()
+            yield from URL(location, self.redirects + [location]).stream()
+            return
 
-        cache_control = response_headers.get("cache-control", "")
-        if (
+        directives = parse_cache_control(response_headers.get("cache-control", ""))
+        cacheable = (
             (self.scheme == "http" or self.scheme == "https")
             and status == "200"
-            and "no-store" not in cache_control
-            and "no-cache" not in cache_control
-            and "max-age" in cache_control
-        ):
-            max_age = int(cache_control.split("=")[1])
-            cache[self.get_url_string()] = CacheEntry(content, time.time() + max_age)
-
-        if self.view_source:
-            for entity, char in entities.items():
-                content = content.replace(char, entity)
+            and "no-store" not in directives
+            and (
+                "max-age" in directives
+                or "etag" in response_headers
+                or "last-modified" in response_headers
+            )
+        )
+        if entry is not None and not cacheable:
+            cache.remove(entry.url)
 
-        return content
+        # The raw, possibly compressed, body is written to the cache as it
+        # arrives rather than being kept in memory
+        writer = cache.writer(self.get_url_string()) if cacheable else None
+        if writer is not None:
+            body = self.tee(body, writer)
 
-    def build_request(self):
+        try:
+            yield from self.decode(body, content_encoding)
+        except BaseException:
+            # Includes the caller abandoning the stream part way through
+            pool.discard(connection)
+            if writer is not None:
+                writer.abort()
+            raise
+        pool.release(connection, reusable)
+
+        if writer is not None:
+            writer.commit(response_headers, expiry(response_headers))
+
+    def tee(
+        self, body: Iterable[memoryview], writer: CacheWriter
+    ) -> Iterator[memoryview]:
+        for chunk in body:
+            writer.write(chunk)
+            yield chunk
+
+    def decode(
+        self, body: Iterable[memoryview | bytes], content_encoding: str
+    ) -> Iterator[str]:
+        for text in decode_body(body, content_encoding):
+            if self.view_source:
+                text = encode(text)
+            yield text
+
+    def build_request(self, extra_headers: dict[str, str] | None = None):
+        if extra_headers is None:
+            extra_headers = {}
         request = "GET {} HTTP/1.1\r\n".format(self.path)
         request += "Host: {}\r\n".format(self.host)
-        for header, value in self.headers.items():
+        for header, value in (self.headers | extra_headers).items():
             request += "{}: {}\r\n".format(header, value)
         request += "\r\n"
         return request
 
-    def get_socket(self):
-        if (self.host, self.port) in sockets:
-            return sockets[(self.host, self.port)]
-
-        s = socket.socket(
-            family=socket.AF_INET,
-            type=socket.SOCK_STREAM,
-            proto=socket.IPPROTO_TCP,
-        )
+    def send_request(self, extra_headers: dict[str, str] | None = None):
+        key = (self.scheme, self.host, self.port)
+        request = self.build_request(extra_headers).encode("utf8")
 
-        s.connect((self.host, self.port))
-        sockets[(self.host, self.port)] = s
+        connection = pool.acquire(key)
+        try:
+            return connection, *self.read_response_head(connection, request)
+        except OSError:
+            pool.discard(connection)
+            if not connection.reused:
+                raise
+
+        # The server closed the pooled connection, so retry on a fresh one
+        connection = pool.acquire(key, reuse=False)
+        try:
+            return connection, *self.read_response_head(connection, request)
+        except BaseException:
+            pool.discard(connection)
+            raise
+
+    def read_response_head(self, connection: Connection, request: bytes):
+        with tracing.span("headers", "network"):
+            connection.sock.sendall(request)
+
+            response = connection.file
+            statusline = response.readline().decode("utf8")
+            if not statusline:
+                raise ConnectionClosed(f"Connection to {self.host} closed")
+            _version, status, _explanation = statusline.split(" ", 2)
+
+            response_headers: dict[str, str] = {}
+            while True:
+                line = response.readline().decode("utf8")
+                if line == "\r\n":
+                    break
+                if not line:
+                    raise ConnectionClosed(f"Connection to {self.host} closed")
+                header, value = line.split(":", 1)
+                response_headers[header.casefold()] = value.strip()
 
-        return s
+            return status, response_headers